@@ -0,0 +1,381 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shlex
+import sys
+import time
+
+import torch
+
+from train import (TINY_MODEL_NAME, StageTimer, ValidationEngine,
+                   add_placeholder_tokens, load_models, parse_args, train)
+
+# metrics that fail the comparison with a baseline, and whether higher is better
+GATED_METRICS = {
+    "steps_per_sec": True,
+    "peak_memory_mb": False,
+    "clip_score": True,
+}
+
+
+def parse_benchmark_args():
+    parser = argparse.ArgumentParser(
+        description=
+        ("Train on every relation of a ReVersion benchmark for a fixed number of steps and report"
+         " the training throughput, per-stage time, peak memory and CLIP score of the samples."))
+    parser.add_argument(
+        "--benchmark_dir",
+        type=str,
+        default="reversion_benchmark_v1",
+        help="Folder with one sub folder of exemplars and `text.json` per relation.",
+    )
+    parser.add_argument(
+        "--relations",
+        type=str,
+        nargs="+",
+        default=None,
+        help="Only benchmark these relations.",
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help=
+        "Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--tiny",
+        action="store_true",
+        help=
+        ("Benchmark the built-in, randomly initialized tiny model of train.py instead of"
+         " `--pretrained_model_name_or_path`, e.g. on a machine without GPU."),
+    )
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=None,
+        help="Training resolution, defaults to 512, or 128 with `--tiny`.",
+    )
+    parser.add_argument(
+        "--train_batch_size", type=int, default=2, help="Training batch size.")
+    parser.add_argument(
+        "--max_train_steps",
+        type=int,
+        default=30,
+        help="Number of training steps per relation.",
+    )
+    parser.add_argument(
+        "--warmup_steps",
+        type=int,
+        default=5,
+        help="Number of first steps left out of the timings.",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "fp16", "bf16"],
+        help="Mixed precision of the training runs.",
+    )
+    parser.add_argument(
+        "--seed", type=int, default=0, help="Seed of the training runs.")
+    parser.add_argument(
+        "--train_args",
+        type=str,
+        default="",
+        help=
+        'Extra train.py arguments, e.g. --train_args="--gan_loss_weight 0.1 --cache_latents".',
+    )
+    parser.add_argument(
+        "--score_prompts",
+        type=str,
+        nargs="+",
+        default=["cat <R> table", "spiderman <R> car", "plant <R> stool"],
+        help="Prompts sampled after training to compute the CLIP score.",
+    )
+    parser.add_argument(
+        "--num_score_samples",
+        type=int,
+        default=None,
+        help=
+        ("Samples per score prompt, 0 skips the CLIP score (which needs the clip package and"
+         " downloads the CLIP model). Defaults to 4, or 0 with `--tiny`."),
+    )
+    parser.add_argument(
+        "--num_inference_steps",
+        type=int,
+        default=25,
+        help="Denoising steps of the scored samples.",
+    )
+    parser.add_argument(
+        "--clip_model",
+        type=str,
+        default="ViT-B/16",
+        help="Name of the CLIP model.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default="benchmark_results",
+        help="Where the training runs and `report.json` are written.",
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default=None,
+        help=
+        "A previous `report.json` to compare with, the exit code is 1 if a gated metric regressed.",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="Relative change of throughput and peak memory tolerated against the baseline.",
+    )
+    parser.add_argument(
+        "--clip_tolerance",
+        type=float,
+        default=0.01,
+        help="Absolute decrease of the CLIP score tolerated against the baseline.",
+    )
+    args = parser.parse_args()
+
+    if args.tiny == (args.pretrained_model_name_or_path is not None):
+        raise ValueError(
+            "Specify exactly one of `--pretrained_model_name_or_path` and `--tiny`."
+        )
+    if args.resolution is None:
+        args.resolution = 128 if args.tiny else 512
+    if args.num_score_samples is None:
+        args.num_score_samples = 0 if args.tiny else 4
+    if args.num_score_samples > 0:
+        from inference import unique_prompts
+
+        args.score_prompts = unique_prompts(args.score_prompts)
+    if args.warmup_steps >= args.max_train_steps:
+        raise ValueError("`--warmup_steps` must be smaller than `--max_train_steps`.")
+    if args.relations is None:
+        args.relations = sorted(
+            name for name in os.listdir(args.benchmark_dir) if os.path.exists(
+                os.path.join(args.benchmark_dir, name, "text.json")))
+
+    return args
+
+
+def relation_train_args(args, model_path, relation):
+    return parse_args([
+        "--pretrained_model_name_or_path", model_path,
+        "--train_data_dir", os.path.join(args.benchmark_dir, relation),
+        "--placeholder_token", "<R>",
+        "--initializer_token", "and",
+        "--output_dir", os.path.join(args.output_dir, "runs", relation),
+        "--resolution", str(args.resolution),
+        "--train_batch_size", str(args.train_batch_size),
+        "--max_train_steps", str(args.max_train_steps),
+        "--save_steps", str(args.max_train_steps + 1),
+        "--checkpointing_steps", str(args.max_train_steps + 1),
+        "--mixed_precision", args.mixed_precision,
+        "--seed", str(args.seed),
+        "--only_save_embeds",
+    ] + shlex.split(args.train_args))
+
+
+def reset_peak_memory(device):
+    """Start measuring the peak memory anew, returns False when only the process peak is available."""
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return True
+    try:
+        # resets the peak resident set size (VmHWM) of the process on Linux
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_memory_mb(device):
+    """Peak allocated device memory, or peak resident memory on CPU, since `reset_peak_memory`."""
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    # kilobytes on Linux, the peak of the whole process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+
+
+def timing_metrics(stage_timer, warmup_steps):
+    steps = stage_timer.steps[warmup_steps:]
+    total = sum(step["step"] for step in steps)
+    stage_names = sorted({name for step in steps for name in step} - {"step"})
+    return {
+        "steps_per_sec": len(steps) / total,
+        "step_ms": 1000 * total / len(steps),
+        "stage_ms": {
+            name: 1000 * sum(step.get(name, 0.0)
+                             for step in steps) / len(steps)
+            for name in stage_names
+        },
+    }
+
+
+def clip_score(args, scorer, models, placeholder_token_ids, device, run_dir):
+    """Mean CLIP score of samples of the score prompts with the learned embedding.
+
+    The samples are written to `run_dir/inference/<prompt>/samples`, as inference.py does.
+    """
+    from cal_acc import prompt_text
+
+    tokenizer, noise_scheduler, text_encoder, vae, unet = models
+    # training leaves the vae on cpu when the exemplar latents are cached
+    vae.to(device)
+    engine = ValidationEngine(
+        tokenizer,
+        text_encoder,
+        unet,
+        vae,
+        noise_scheduler,
+        device,
+        placeholder_token_ids,
+        num_inference_steps=args.num_inference_steps)
+    paths, texts = [], []
+    for prompt in args.score_prompts:
+        samples_dir = os.path.join(run_dir, "inference", prompt, "samples")
+        os.makedirs(samples_dir, exist_ok=True)
+        images = engine.generate(
+            engine.encode([prompt] * args.num_score_samples),
+            list(range(args.num_score_samples)))
+        for i, image in enumerate(images):
+            paths.append(os.path.join(samples_dir, f"{i:04d}.png"))
+            image.save(paths[-1])
+        texts += [prompt_text(prompt, "<R>", "and")] * len(images)
+
+    scores = scorer.score(paths, texts)
+    return sum(scores) / len(scores)
+
+
+def compare(report, baseline, tolerance, clip_tolerance):
+    """Print the changes against `baseline` and return the regressed gated metrics."""
+    regressions = []
+    print(f"{'relation':<16}{'metric':<28}{'baseline':>12}{'current':>12}{'change':>10}")
+    for relation, metrics in report["relations"].items():
+        if relation not in baseline["relations"]:
+            continue
+        base_metrics = baseline["relations"][relation]
+        # peaks of the whole process and of a single relation are not comparable
+        skipped = set()
+        if metrics.get("peak_memory_scope", "relation") != base_metrics.get(
+                "peak_memory_scope", "relation"):
+            skipped.add("peak_memory_mb")
+        flat = dict(metrics, **{
+            f"stage_ms.{name}": value
+            for name, value in metrics["stage_ms"].items()
+        })
+        base_flat = dict(base_metrics, **{
+            f"stage_ms.{name}": value
+            for name, value in base_metrics["stage_ms"].items()
+        })
+        for name, value in flat.items():
+            base_value = base_flat.get(name)
+            if (not isinstance(value, float)
+                    or not isinstance(base_value, float) or name in skipped):
+                continue
+            change = (value - base_value) / base_value if base_value else 0.0
+            status = ""
+            if name == "clip_score":
+                if value < base_value - clip_tolerance:
+                    status = "REGRESSION"
+            elif name in GATED_METRICS:
+                higher_is_better = GATED_METRICS[name]
+                if (change < -tolerance
+                        if higher_is_better else change > tolerance):
+                    status = "REGRESSION"
+            if status:
+                regressions.append((relation, name))
+            print(f"{relation:<16}{name:<28}{base_value:>12.4f}{value:>12.4f}"
+                  f"{change:>+10.1%} {status}")
+    return regressions
+
+
+def main():
+    args = parse_benchmark_args()
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    model_path = TINY_MODEL_NAME if args.tiny else args.pretrained_model_name_or_path
+    base_args = relation_train_args(args, model_path, args.relations[0])
+    models = load_models(base_args)
+    # the local path of the tiny model
+    model_path = base_args.pretrained_model_name_or_path
+    placeholder_token_ids, initializer_token_ids = add_placeholder_tokens(
+        models[0], models[2], base_args)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    scorer = None
+    if args.num_score_samples > 0:
+        # only imported when scoring, so that the benchmark runs without the clip package.
+        # Loaded once before the runs, its weights add the same offset to the peak memory
+        # of every relation.
+        from cal_acc import CLIPScorer
+        scorer = CLIPScorer(args.clip_model, device=device.type)
+
+    report = {
+        "config": {
+            key: value
+            for key, value in vars(args).items() if key != "baseline"
+        },
+        "environment": {
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "device": torch.cuda.get_device_name(device)
+            if device.type == "cuda" else platform.processor() or "cpu",
+            "num_threads": torch.get_num_threads(),
+        },
+        "relations": {},
+    }
+    for relation in args.relations:
+        print(f"Benchmarking {relation}")
+        train_args = relation_train_args(args, model_path, relation)
+        per_relation_peak = reset_peak_memory(device)
+        stage_timer = StageTimer(device)
+        start = time.perf_counter()
+        # the workers of persistent dataloaders would outlive the run
+        train(train_args,
+              models,
+              placeholder_token_ids,
+              initializer_token_ids,
+              stage_timer,
+              persistent_workers=False)
+        metrics = timing_metrics(stage_timer, args.warmup_steps)
+        metrics["train_sec"] = time.perf_counter() - start
+        metrics["peak_memory_mb"] = peak_memory_mb(device)
+        metrics["peak_memory_scope"] = "relation" if per_relation_peak else "process"
+        if scorer is not None:
+            metrics["clip_score"] = clip_score(args, scorer, models,
+                                               placeholder_token_ids, device,
+                                               train_args.output_dir)
+        report["relations"][relation] = metrics
+        print(json.dumps(metrics, indent=2))
+
+    report_path = os.path.join(args.output_dir, "report.json")
+    with open(report_path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {report_path}")
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance,
+                              args.clip_tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,31 +1,314 @@
-import torch
+import argparse
+import collections
+import concurrent.futures
+import csv
+import hashlib
+import os
+
 import clip
+import torch
 from PIL import Image
 
-# 加载CLIP模型
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/16", device=device)
-sum = 0
-for i in range(4):
-    image_path = "/u/fu1/ece449/Reversion_GAN/on_with_GAN_and_L_try_4/inference/cat <R> table/samples/000"+str(i)+'.png'
-    image = preprocess(Image.open(image_path)).unsqueeze(0).to(device)
-
-    text = "cat and table"  # 替换为你的输入字符串
-    text_tokens = clip.tokenize([text]).to(device)
-
-    # 计算特征
-    with torch.no_grad():
-        image_features = model.encode_image(image)
-        text_features = model.encode_text(text_tokens)
-
-    # 归一化特征
-    image_features /= image_features.norm(dim=-1, keepdim=True)
-    text_features /= text_features.norm(dim=-1, keepdim=True)
-
-    # 计算相似性分数
-    similarity = (image_features @ text_features.T).item()
-
-    print(f"Similarity score: {similarity:.4f}")
-    sum+=similarity
-    
-print("avg:", sum/4)
\ No newline at end of file
+IMG_EXTENSIONS = ('.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG', '.ppm',
+                  '.PPM', '.bmp', '.BMP', '.tif')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=
+        ("CLIP score the samples of every `inference/<prompt>/samples` directory found under the"
+         " given roots, against the prompt with the relation token replaced by a plain word."))
+    parser.add_argument(
+        "roots",
+        type=str,
+        nargs="+",
+        help="Directories searched for `inference` trees, e.g. `on_with_GAN_and_L_try_*`.",
+    )
+    parser.add_argument(
+        "--clip_model",
+        type=str,
+        default="ViT-B/16",
+        help="Name of the CLIP model.",
+    )
+    parser.add_argument(
+        "--placeholder_token",
+        type=str,
+        default="<R>",
+        help="The relation token in the prompt directory names.",
+    )
+    parser.add_argument(
+        "--relation_text",
+        type=str,
+        default="and",
+        help=
+        "What the placeholder token is replaced with, `cat <R> table` is scored against `cat and table`.",
+    )
+    parser.add_argument(
+        "--text",
+        type=str,
+        default=None,
+        help="Score every sample against this text instead of its prompt.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of images encoded together.",
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=8,
+        help="Number of threads decoding and preprocessing images.",
+    )
+    parser.add_argument(
+        "--cache_path",
+        type=str,
+        default=None,
+        help=
+        ("Where image features are cached, keyed by file content hash. Defaults to"
+         " `~/.cache/reversion/clip_<clip_model>.pt`."),
+    )
+    parser.add_argument(
+        "--output_csv",
+        type=str,
+        default=None,
+        help=
+        "Also write the tables to `<output_csv>_prompts.csv` and `<output_csv>_experiments.csv`.",
+    )
+    args = parser.parse_args()
+
+    if args.cache_path is None:
+        args.cache_path = os.path.join(
+            os.path.expanduser("~"), ".cache", "reversion",
+            f"clip_{args.clip_model.replace('/', '-')}.pt")
+
+    return args
+
+
+def find_samples(root):
+    """Yield `(experiment, prompt, image_path)` of the samples of the inference trees under `root`.
+
+    `experiment` is the directory containing `inference`.
+    """
+    for dirpath, dirnames, _ in os.walk(root):
+        dirnames.sort()
+        if os.path.basename(dirpath) != "inference":
+            continue
+        experiment = os.path.dirname(dirpath)
+        for prompt in dirnames:
+            samples_dir = os.path.join(dirpath, prompt, "samples")
+            if not os.path.isdir(samples_dir):
+                continue
+            for name in sorted(os.listdir(samples_dir)):
+                if name.endswith(IMG_EXTENSIONS):
+                    yield experiment, prompt, os.path.join(samples_dir, name)
+
+
+def prompt_text(prompt, placeholder_token, relation_text):
+    """The text a sample of `prompt` is scored against, e.g. `cat and table` for `cat <R> table`."""
+    return " ".join(prompt.replace(placeholder_token, relation_text).split())
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class CLIPScorer:
+    """Cosine similarities between images and texts in CLIP space.
+
+    Images are decoded and preprocessed by a thread pool while the previous batch is
+    encoded. Their features are cached on disk by content hash, and the hash of a file
+    is only recomputed when its size or mtime changes, so rescoring only encodes new
+    files. Each distinct text is encoded once.
+    """
+
+    def __init__(self,
+                 clip_model="ViT-B/16",
+                 device=None,
+                 cache_path=None,
+                 batch_size=64,
+                 num_workers=8):
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = device
+        self.clip_model = clip_model
+        self.model, self.preprocess = clip.load(clip_model, device=device)
+        self.model.eval()
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.cache_path = cache_path
+        self.text_features = {}
+
+        self.features = {}
+        self.file_hashes = {}
+        if cache_path is not None and os.path.exists(cache_path):
+            cache = torch.load(cache_path)
+            if cache["clip_model"] == clip_model:
+                self.features = cache["features"]
+                self.file_hashes = cache["file_hashes"]
+        self.dirty = False
+
+    def hash(self, path):
+        stat = os.stat(path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        entry = self.file_hashes.get(path)
+        if entry is None or tuple(entry[:2]) != stamp:
+            entry = stamp + (file_hash(path), )
+            self.file_hashes[path] = entry
+            self.dirty = True
+        return entry[2]
+
+    def load(self, path):
+        return self.preprocess(Image.open(path))
+
+    @torch.no_grad()
+    def encode_texts(self, texts):
+        """Normalized features of `texts`, encoding the ones not seen before in one batch."""
+        new_texts = sorted(set(texts).difference(self.text_features))
+        if new_texts:
+            features = self.model.encode_text(
+                clip.tokenize(new_texts).to(self.device)).float()
+            features /= features.norm(dim=-1, keepdim=True)
+            self.text_features.update(zip(new_texts, features))
+        return torch.stack([self.text_features[text] for text in texts])
+
+    @torch.no_grad()
+    def encode_images(self, paths):
+        """Normalized features of the images at `paths`, encoding only the uncached files."""
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.num_workers) as executor:
+            hashes = list(executor.map(self.hash, paths))
+            missing = sorted(
+                {h: path
+                 for h, path in zip(hashes, paths)
+                 if h not in self.features}.items())
+            batches = [
+                missing[i:i + self.batch_size]
+                for i in range(0, len(missing), self.batch_size)
+            ]
+
+            # preprocessing of the next batch runs while the current one is encoded
+            next_images = None
+            if batches:
+                next_images = [
+                    executor.submit(self.load, path)
+                    for _, path in batches[0]
+                ]
+            for i, batch in enumerate(batches):
+                images = next_images
+                if i + 1 < len(batches):
+                    next_images = [
+                        executor.submit(self.load, path)
+                        for _, path in batches[i + 1]
+                    ]
+                images = torch.stack([image.result() for image in images])
+                features = self.model.encode_image(images.to(
+                    self.device)).float()
+                features /= features.norm(dim=-1, keepdim=True)
+                for (h, _), feature in zip(batch, features.cpu()):
+                    self.features[h] = feature.half()
+                self.dirty = True
+
+        return torch.stack([self.features[h] for h in hashes]).float().to(
+            self.device)
+
+    def score(self, paths, texts):
+        """Cosine similarity between the image at `paths[i]` and `texts[i]`."""
+        if not paths:
+            return []
+        image_features = self.encode_images(paths)
+        text_features = self.encode_texts(texts)
+        return (image_features * text_features).sum(-1).tolist()
+
+    def save(self):
+        if self.cache_path is None or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)),
+                    exist_ok=True)
+        torch.save(
+            {
+                "clip_model": self.clip_model,
+                "features": self.features,
+                "file_hashes": self.file_hashes,
+            }, self.cache_path)
+        self.dirty = False
+
+
+def score_tables(samples, scores):
+    """Mean scores per `(experiment, prompt)` and per experiment of the scored `samples`."""
+    prompt_scores = collections.defaultdict(list)
+    for (experiment, prompt, _), score in zip(samples, scores):
+        prompt_scores[experiment, prompt].append(score)
+    prompt_rows = [(experiment, prompt, len(values), sum(values) / len(values))
+                   for (experiment, prompt), values in prompt_scores.items()]
+
+    experiment_scores = collections.defaultdict(list)
+    for experiment, _, _, mean in prompt_rows:
+        experiment_scores[experiment].append(mean)
+    image_counts = collections.Counter(
+        experiment for experiment, _, _ in samples)
+    # experiments are averaged over prompts, so every prompt weighs the same
+    experiment_rows = [(experiment, len(means), image_counts[experiment],
+                        sum(means) / len(means))
+                       for experiment, means in experiment_scores.items()]
+    return prompt_rows, experiment_rows
+
+
+def print_table(header, rows):
+    rows = [[f"{value:.4f}" if isinstance(value, float) else str(value)
+             for value in row] for row in rows]
+    widths = [
+        max(len(row[i]) for row in [header] + rows)
+        for i in range(len(header))
+    ]
+    for row in [header] + rows:
+        print("  ".join(value.ljust(width)
+                        for value, width in zip(row, widths)))
+
+
+def write_csv(path, header, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(rows)
+
+
+def main():
+    args = parse_args()
+
+    samples = [
+        sample for root in args.roots for sample in find_samples(root)
+    ]
+    if not samples:
+        raise ValueError(f"No inference samples found under {args.roots}.")
+
+    scorer = CLIPScorer(
+        args.clip_model,
+        cache_path=args.cache_path,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers)
+    texts = [
+        args.text if args.text is not None else prompt_text(
+            prompt, args.placeholder_token, args.relation_text)
+        for _, prompt, _ in samples
+    ]
+    scores = scorer.score([path for _, _, path in samples], texts)
+    scorer.save()
+
+    prompt_rows, experiment_rows = score_tables(samples, scores)
+    prompt_header = ["experiment", "prompt", "images", "clip_score"]
+    experiment_header = ["experiment", "prompts", "images", "clip_score"]
+    print_table(prompt_header, prompt_rows)
+    print()
+    print_table(experiment_header, experiment_rows)
+    if args.output_csv is not None:
+        write_csv(f"{args.output_csv}_prompts.csv", prompt_header,
+                  prompt_rows)
+        write_csv(f"{args.output_csv}_experiments.csv", experiment_header,
+                  experiment_rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+import argparse
+import collections
+import concurrent.futures
+import math
+import os
+
+import torch
+from diffusers import StableDiffusionPipeline
+from PIL import Image
+
+from train import ValidationEngine, load_models
+
+
+def unique_prompts(prompts):
+    """`prompts` without repeats, after checking that each can name its output directory."""
+    for prompt in prompts:
+        if (prompt in ("", ".", "..") or os.sep in prompt
+                or (os.altsep is not None and os.altsep in prompt)):
+            raise ValueError(
+                f"The prompt {prompt!r} names its output directory, it can neither contain a path"
+                " separator nor be empty, `.` or `..`.")
+    # the samples of a repeated prompt would be the same, written to the same files
+    return list(dict.fromkeys(prompts))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=
+        ("Generate samples of prompts containing learned relation tokens, written to"
+         " `output_dir/<prompt>/samples/0000.png` with a grid `output_dir/<prompt>/<prompt>.png`."
+         ))
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        required=True,
+        help=
+        "Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--revision",
+        type=str,
+        default=None,
+        required=False,
+        help="Revision of pretrained model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default=None,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument(
+        "--model_id",
+        type=str,
+        default=None,
+        help=
+        ("The output directory of a training run. Its `learned_embeds.bin` is loaded unless"
+         " `--learned_embeds` is given, and samples are written to `model_id/inference`."),
+    )
+    parser.add_argument(
+        "--learned_embeds",
+        type=str,
+        nargs="+",
+        default=None,
+        help="One or more `learned_embeds.bin` files to load.",
+    )
+    parser.add_argument(
+        "--prompt",
+        type=str,
+        nargs="+",
+        default=[],
+        help="Prompts to sample, containing the placeholder token, e.g. `cat <R> table`.",
+    )
+    parser.add_argument(
+        "--prompt_file",
+        type=str,
+        default=None,
+        help="A text file with one prompt per line, sampled after `--prompt`.",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=None,
+        help="Where to write the samples. Defaults to `model_id/inference`.",
+    )
+    parser.add_argument(
+        "--num_samples",
+        type=int,
+        default=10,
+        help="Number of samples generated for each prompt.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=8,
+        help=
+        "Number of samples denoised together, batches span several prompts when needed.",
+    )
+    parser.add_argument(
+        "--num_inference_steps",
+        type=int,
+        default=50,
+        help="Number of denoising steps.",
+    )
+    parser.add_argument(
+        "--guidance_scale",
+        type=float,
+        default=7.5,
+        help="Classifier free guidance scale.",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help=
+        "Sample i of every prompt is seeded with `seed + i`, independently of the batching.",
+    )
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default=None,
+        choices=["no", "fp16", "bf16"],
+        help=
+        "Precision of the unet and vae. Defaults to fp16 on GPU and no on CPU.",
+    )
+    parser.add_argument(
+        "--weight_cache_dir",
+        type=str,
+        default=None,
+        help=
+        "Memory-map the unet and vae from copies cast to `--mixed_precision` in this directory, as train.py does.",
+    )
+    args = parser.parse_args()
+
+    if args.learned_embeds is None:
+        if args.model_id is None:
+            raise ValueError(
+                "You must specify `--model_id` or `--learned_embeds`.")
+        args.learned_embeds = [
+            os.path.join(args.model_id, "learned_embeds.bin")
+        ]
+    if args.output_dir is None:
+        if args.model_id is None:
+            raise ValueError(
+                "You must specify `--output_dir` when `--model_id` is not given."
+            )
+        args.output_dir = os.path.join(args.model_id, "inference")
+    if args.prompt_file is not None:
+        with open(args.prompt_file) as f:
+            args.prompt += [line.rstrip("\n") for line in f if line.strip()]
+    if not args.prompt:
+        raise ValueError("You must specify `--prompt` or `--prompt_file`.")
+    args.prompt = unique_prompts(args.prompt)
+
+    return args
+
+
+def load_learned_embeds(tokenizer, text_encoder, paths):
+    """Add the tokens of the `learned_embeds.bin` files at `paths` with their learned rows."""
+    learned_embeds = {}
+    for path in paths:
+        learned_embeds.update(torch.load(path, map_location="cpu"))
+
+    for token in learned_embeds:
+        if tokenizer.add_tokens(token) == 0:
+            raise ValueError(f"The tokenizer already contains the token {token}.")
+    text_encoder.resize_token_embeddings(len(tokenizer))
+
+    token_embeds = text_encoder.get_input_embeddings().weight.data
+    for token, embed in learned_embeds.items():
+        token_embeds[tokenizer.convert_tokens_to_ids(token)] = embed.to(
+            token_embeds.dtype)
+    return list(learned_embeds)
+
+
+def image_grid(images):
+    """Tile `images` in the most square grid with as many rows as columns or fewer."""
+    rows = int(math.sqrt(len(images)))
+    while len(images) % rows:
+        rows -= 1
+    cols = len(images) // rows
+    w, h = images[0].size
+    grid = Image.new("RGB", size=(cols * w, rows * h))
+    for i, image in enumerate(images):
+        grid.paste(image, box=(i % cols * w, i // cols * h))
+    return grid
+
+
+class SampleWriter:
+    """Converts and writes generated batches on a worker thread.
+
+    The next batch is denoised while the previous ones are encoded to PNG and written.
+    The grid of a prompt is written once its last sample is.
+    """
+
+    def __init__(self, output_dir, prompts, num_samples, max_pending=2):
+        self.output_dir = output_dir
+        self.prompts = prompts
+        self.num_samples = num_samples
+        self.max_pending = max_pending
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.pending = collections.deque()
+        self.samples = collections.defaultdict(dict)
+
+        for prompt in prompts:
+            os.makedirs(
+                os.path.join(output_dir, prompt, "samples"), exist_ok=True)
+
+    def submit(self, images, items):
+        """Queue the (N, H, W, 3) array `images` of the `(prompt_index, sample_index)` `items`."""
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(self._write, images, items))
+
+    def _write(self, images, items):
+        for image, (p, i) in zip(
+                StableDiffusionPipeline.numpy_to_pil(images), items):
+            prompt = self.prompts[p]
+            image.save(
+                os.path.join(self.output_dir, prompt, "samples",
+                             f"{i:04d}.png"))
+            self.samples[p][i] = image
+            if len(self.samples[p]) == self.num_samples:
+                samples = self.samples.pop(p)
+                image_grid([samples[i] for i in range(self.num_samples)]).save(
+                    os.path.join(self.output_dir, prompt, f"{prompt}.png"))
+
+    def close(self):
+        while self.pending:
+            self.pending.popleft().result()
+        self.executor.shutdown()
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.mixed_precision is None:
+        args.mixed_precision = "fp16" if device.type == "cuda" else "no"
+    weight_dtype = {
+        "no": torch.float32,
+        "fp16": torch.float16,
+        "bf16": torch.bfloat16
+    }[args.mixed_precision]
+
+    tokenizer, noise_scheduler, text_encoder, vae, unet = load_models(args)
+    tokens = load_learned_embeds(tokenizer, text_encoder, args.learned_embeds)
+    print(f"Loaded {', '.join(tokens)} from {', '.join(args.learned_embeds)}")
+
+    text_encoder.to(device)
+    unet.to(device, dtype=weight_dtype)
+    vae.to(device, dtype=weight_dtype)
+    engine = ValidationEngine(
+        tokenizer,
+        text_encoder,
+        unet,
+        vae,
+        noise_scheduler,
+        device,
+        tokenizer.convert_tokens_to_ids(tokens),
+        num_inference_steps=args.num_inference_steps,
+        guidance_scale=args.guidance_scale)
+
+    items = [(p, i) for p in range(len(args.prompt))
+             for i in range(args.num_samples)]
+
+    writer = SampleWriter(args.output_dir, args.prompt, args.num_samples)
+    for start in range(0, len(items), args.batch_size):
+        batch = items[start:start + args.batch_size]
+        images = engine.generate(
+            # each prompt is only run through the text encoder for its first sample
+            engine.encode([args.prompt[p] for p, _ in batch]),
+            [args.seed + i for _, i in batch],
+            output_type="np")
+        writer.submit(images, batch)
+        print(f"Generated {start + len(batch)}/{len(items)} samples")
+    writer.close()
+    print(
+        f"Encoded {engine.embedding_cache.misses} prompts for {len(items)} samples"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+import argparse
+import json
+import os
+
+import numpy as np
+from transformers import CLIPTokenizer
+
+from train import ImageShard, ReVersionDataset
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=
+        "Pack the exemplars and coarse descriptions of a relation into a memory-mappable shard."
+    )
+    parser.add_argument(
+        "--pretrained_model_name_or_path",
+        type=str,
+        default=None,
+        help=
+        "Path to pretrained model or model identifier from huggingface.co/models.",
+    )
+    parser.add_argument(
+        "--tokenizer_name",
+        type=str,
+        default=None,
+        help="Pretrained tokenizer name or path if not the same as model_name",
+    )
+    parser.add_argument(
+        "--train_data_dir",
+        type=str,
+        required=True,
+        help=
+        "The folder that contains the exemplar images (and coarse descriptions) of the specific relation."
+    )
+    parser.add_argument(
+        "--placeholder_token",
+        type=str,
+        required=True,
+        help="A token to use as a placeholder for the relation.",
+    )
+    parser.add_argument(
+        "--resolution",
+        type=int,
+        default=512,
+        help="The resolution the exemplars are resized to.",
+    )
+    parser.add_argument(
+        "--center_crop",
+        action="store_true",
+        help="Whether to center crop images before resizing to resolution.")
+    parser.add_argument(
+        "--output_path",
+        type=str,
+        default=None,
+        help=
+        "Where to write the shard. Defaults to `train_data_dir/reversion.shard`.",
+    )
+    args = parser.parse_args()
+
+    if args.tokenizer_name is None and args.pretrained_model_name_or_path is None:
+        raise ValueError(
+            "You must specify `--pretrained_model_name_or_path` or `--tokenizer_name`."
+        )
+    if args.output_path is None:
+        args.output_path = os.path.join(args.train_data_dir, "reversion.shard")
+
+    return args
+
+
+def write_shard(dataset, path):
+    """Write the preprocessed pixels and tokenized templates of `dataset` to `path`."""
+    tokenizer = dataset.tokenizer
+    arrays = {
+        "pixels":
+        np.stack([dataset.load_pixels(i) for i in range(dataset.num_images)]),
+        "template_ids":
+        dataset.template_ids.numpy().astype(np.int32),
+        "template_ranges":
+        np.asarray(dataset.template_ranges, dtype=np.int64),
+    }
+
+    array_specs = {}
+    offset = 0
+    for name, array in arrays.items():
+        array_specs[name] = {
+            "dtype": array.dtype.str,
+            "shape": list(array.shape),
+            "offset": offset,
+        }
+        offset += -(-array.nbytes // ImageShard.ALIGNMENT) * ImageShard.ALIGNMENT
+
+    header = {
+        "size": dataset.size,
+        "center_crop": dataset.center_crop,
+        "placeholder_token": dataset.placeholder_token,
+        "placeholder_token_id":
+        tokenizer.convert_tokens_to_ids(dataset.placeholder_token),
+        "vocab_size": len(tokenizer),
+        "model_max_length": tokenizer.model_max_length,
+        "image_names": [path.split('/')[-1] for path in dataset.image_paths],
+        "arrays": array_specs,
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_offset = ImageShard.data_offset(len(header_bytes))
+
+    with open(path, "wb") as f:
+        f.write(ImageShard.MAGIC)
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_offset + array_specs[name]["offset"])
+            f.write(np.ascontiguousarray(array).tobytes())
+
+
+def main():
+    args = parse_args()
+
+    if args.tokenizer_name:
+        tokenizer = CLIPTokenizer.from_pretrained(args.tokenizer_name)
+    else:
+        tokenizer = CLIPTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="tokenizer")
+    # the templates are tokenized with the placeholder token added, as in train.py
+    tokenizer.add_tokens(args.placeholder_token)
+
+    dataset = ReVersionDataset(
+        data_root=args.train_data_dir,
+        tokenizer=tokenizer,
+        size=args.resolution,
+        placeholder_token=args.placeholder_token,
+        center_crop=args.center_crop,
+        num_positives=0)
+    write_shard(dataset, args.output_path)
+    print(
+        f"Wrote {dataset.num_images} images and {len(dataset.template_ids)} templates to {args.output_path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,308 @@
+import argparse
+import collections
+import json
+import os
+import re
+import sqlite3
+import time
+
+from cal_acc import (CLIPScorer, file_hash, find_samples, print_table,
+                     prompt_text)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    relation TEXT,
+    args TEXT,
+    scanned_at REAL
+);
+CREATE TABLE IF NOT EXISTS embeds (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    path TEXT NOT NULL,
+    step INTEGER,
+    PRIMARY KEY (run_id, path)
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha1 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS samples (
+    path TEXT PRIMARY KEY REFERENCES files(path),
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    prompt TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scores (
+    sha1 TEXT NOT NULL,
+    text TEXT NOT NULL,
+    clip_model TEXT NOT NULL,
+    score REAL NOT NULL,
+    PRIMARY KEY (sha1, text, clip_model)
+);
+CREATE INDEX IF NOT EXISTS samples_run ON samples(run_id);
+"""
+
+EMBEDS_PATTERN = re.compile(r"^learned_embeds(?:-steps-(\d+))?\.bin$")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description=
+        ("Index the args, learned embeddings and CLIP scored samples of training runs into a"
+         " SQLite database, and rank the runs."))
+    parser.add_argument(
+        "--db",
+        type=str,
+        default="results.sqlite",
+        help="Path of the SQLite database.",
+    )
+    parser.add_argument(
+        "--clip_model",
+        type=str,
+        default="ViT-B/16",
+        help="Name of the CLIP model the samples are scored with.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    scan = subparsers.add_parser(
+        "scan",
+        help=
+        "Index the runs under the given roots, only hashing and scoring new or modified samples.",
+    )
+    scan.add_argument("roots", type=str, nargs="+")
+    scan.add_argument(
+        "--relation",
+        type=str,
+        default=None,
+        help=
+        "Relation of the runs without an `args.json`, defaults to the name of the run directory.",
+    )
+    scan.add_argument(
+        "--placeholder_token",
+        type=str,
+        default="<R>",
+        help="The relation token in the prompt directory names.",
+    )
+    scan.add_argument(
+        "--relation_text",
+        type=str,
+        default="and",
+        help="What the placeholder token is replaced with in the scored text.",
+    )
+    scan.add_argument(
+        "--batch_size",
+        type=int,
+        default=64,
+        help="Number of images encoded together.",
+    )
+    scan.add_argument(
+        "--num_workers",
+        type=int,
+        default=8,
+        help="Number of threads decoding and preprocessing images.",
+    )
+
+    rank = subparsers.add_parser(
+        "rank", help="Rank the runs of each relation by mean CLIP score.")
+    rank.add_argument(
+        "--relation",
+        type=str,
+        default=None,
+        help="Only rank the runs of this relation.")
+    rank.add_argument(
+        "--prompt",
+        type=str,
+        default=None,
+        help="Only use the samples of this prompt.")
+    rank.add_argument(
+        "--top",
+        type=int,
+        default=None,
+        help="Only show the best runs of each relation.")
+
+    subparsers.add_parser(
+        "runs", help="List the indexed runs with their learned embeddings.")
+
+    return parser.parse_args()
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    return db
+
+
+def find_runs(root):
+    """Yield the directories under `root` with samples, learned embeddings or an `args.json`."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        if os.path.basename(dirpath) == "inference":
+            dirnames[:] = []
+            continue
+        if ("inference" in dirnames or "args.json" in filenames
+                or any(EMBEDS_PATTERN.match(name) for name in filenames)):
+            yield os.path.normpath(dirpath)
+
+
+def read_run_args(run_dir):
+    """`args.json` of the run, or of the parent run for the relation folders of multi-relation runs."""
+    for path in (os.path.join(run_dir, "args.json"),
+                 os.path.join(os.path.dirname(run_dir), "args.json")):
+        if os.path.exists(path):
+            with open(path) as f:
+                return path, json.load(f)
+    return None, None
+
+
+def run_relation(run_dir, args_path, run_args, default=None):
+    if run_args is not None:
+        data_dirs = run_args.get("train_data_dir") or []
+        if isinstance(data_dirs, str):
+            data_dirs = [data_dirs]
+        if os.path.dirname(args_path) != run_dir:
+            # relation folder of a multi-relation run, named after its data dir
+            return os.path.basename(run_dir)
+        if len(data_dirs) == 1:
+            return os.path.basename(os.path.normpath(data_dirs[0]))
+    if default is not None:
+        return default
+    return os.path.basename(os.path.abspath(run_dir))
+
+
+def update_file(db, path):
+    """Return the sha1 of `path`, only rehashing it when its size or mtime changed."""
+    stat = os.stat(path)
+    row = db.execute("SELECT size, mtime_ns, sha1 FROM files WHERE path = ?",
+                     (path, )).fetchone()
+    if row is not None and row[:2] == (stat.st_size, stat.st_mtime_ns):
+        return row[2]
+    sha1 = file_hash(path)
+    db.execute(
+        "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha1) VALUES (?, ?, ?, ?)",
+        (path, stat.st_size, stat.st_mtime_ns, sha1))
+    return sha1
+
+
+def scan(db, args):
+    run_dirs = sorted(
+        {run_dir
+         for root in args.roots for run_dir in find_runs(root)})
+    unscored = {}
+    for run_dir in run_dirs:
+        args_path, run_args = read_run_args(run_dir)
+        relation = run_relation(run_dir, args_path, run_args, args.relation)
+        db.execute(
+            "INSERT INTO runs (path, relation, args, scanned_at) VALUES (?, ?, ?, ?)"
+            " ON CONFLICT(path) DO UPDATE SET relation = excluded.relation,"
+            " args = excluded.args, scanned_at = excluded.scanned_at",
+            (run_dir, relation,
+             None if run_args is None else json.dumps(run_args), time.time()))
+        run_id = db.execute("SELECT id FROM runs WHERE path = ?",
+                            (run_dir, )).fetchone()[0]
+
+        db.execute("DELETE FROM embeds WHERE run_id = ?", (run_id, ))
+        for name in sorted(os.listdir(run_dir)):
+            match = EMBEDS_PATTERN.match(name)
+            if match:
+                step = match.group(1)
+                db.execute(
+                    "INSERT INTO embeds (run_id, path, step) VALUES (?, ?, ?)",
+                    (run_id, os.path.join(run_dir, name),
+                     None if step is None else int(step)))
+
+        # samples of this run only, the runs nested in it are indexed on their own
+        samples = [
+            sample for sample in find_samples(run_dir)
+            if os.path.normpath(sample[0]) == run_dir
+        ]
+        db.execute("DELETE FROM samples WHERE run_id = ?", (run_id, ))
+        for _, prompt, path in samples:
+            sha1 = update_file(db, path)
+            text = prompt_text(prompt, args.placeholder_token,
+                               args.relation_text)
+            db.execute(
+                "INSERT OR REPLACE INTO samples (path, run_id, prompt, text) VALUES (?, ?, ?, ?)",
+                (path, run_id, prompt, text))
+            if db.execute(
+                    "SELECT 1 FROM scores WHERE sha1 = ? AND text = ? AND clip_model = ?",
+                (sha1, text, args.clip_model)).fetchone() is None:
+                unscored[sha1, text] = path
+        print(f"{run_dir}: {relation}, {len(samples)} samples")
+
+    if unscored:
+        print(f"Scoring {len(unscored)} new samples")
+        scorer = CLIPScorer(
+            args.clip_model,
+            batch_size=args.batch_size,
+            num_workers=args.num_workers)
+        keys = list(unscored)
+        scores = scorer.score([unscored[key] for key in keys],
+                              [text for _, text in keys])
+        db.executemany(
+            "INSERT OR REPLACE INTO scores (sha1, text, clip_model, score) VALUES (?, ?, ?, ?)",
+            [(sha1, text, args.clip_model, score)
+             for (sha1, text), score in zip(keys, scores)])
+    db.commit()
+
+
+def rank(db, args):
+    """Rank runs by their mean CLIP score over prompts, each prompt averaged over its samples."""
+    query = """
+        SELECT relation, path, COUNT(*), SUM(images), AVG(prompt_score) FROM (
+            SELECT runs.id, runs.relation, runs.path, samples.prompt,
+                   COUNT(*) AS images, AVG(scores.score) AS prompt_score
+            FROM samples
+            JOIN runs ON runs.id = samples.run_id
+            JOIN files ON files.path = samples.path
+            JOIN scores ON scores.sha1 = files.sha1 AND scores.text = samples.text
+                AND scores.clip_model = ?
+            WHERE (? IS NULL OR runs.relation = ?) AND (? IS NULL OR samples.prompt = ?)
+            GROUP BY runs.id, samples.prompt
+        )
+        GROUP BY id
+        ORDER BY relation, AVG(prompt_score) DESC
+    """
+    rows = db.execute(query, (args.clip_model, args.relation, args.relation,
+                              args.prompt, args.prompt)).fetchall()
+    if args.top is not None:
+        counts = collections.Counter()
+        top_rows = []
+        for row in rows:
+            counts[row[0]] += 1
+            if counts[row[0]] <= args.top:
+                top_rows.append(row)
+        rows = top_rows
+    print_table(["relation", "run", "prompts", "images", "clip_score"], rows)
+
+
+def list_runs(db):
+    rows = db.execute("""
+        SELECT runs.relation, runs.path,
+               (SELECT COUNT(*) FROM samples WHERE samples.run_id = runs.id),
+               (SELECT MAX(step) FROM embeds WHERE embeds.run_id = runs.id),
+               EXISTS(SELECT 1 FROM embeds WHERE embeds.run_id = runs.id AND step IS NULL)
+        FROM runs ORDER BY runs.relation, runs.path
+    """).fetchall()
+    print_table(["relation", "run", "samples", "last_step", "final_embeds"],
+                [(relation, path, samples, "" if step is None else step,
+                  "yes" if final else "no")
+                 for relation, path, samples, step, final in rows])
+
+
+def main():
+    args = parse_args()
+    db = connect(args.db)
+    if args.command == "scan":
+        scan(db, args)
+    elif args.command == "rank":
+        rank(db, args)
+    else:
+        list_runs(db)
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
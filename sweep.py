@@ -0,0 +1,106 @@
+import argparse
+import copy
+import gc
+import itertools
+import json
+import os
+import re
+
+import torch
+
+from train import add_placeholder_tokens, load_models, parse_args, train
+
+# arguments that change which models are loaded or how the tokenizer is extended,
+# they cannot vary between the runs of one sweep
+MODEL_ARGS = ("pretrained_model_name_or_path", "revision", "tokenizer_name",
+              "placeholder_token", "initializer_token")
+# arguments of the accelerator state, which is created by the first run and shared by all
+# the runs of the process
+PROCESS_ARGS = ("mixed_precision", )
+PATH_SEPARATORS = re.compile(r"[/\\]")
+
+
+def parse_sweep_args():
+    parser = argparse.ArgumentParser(
+        description=
+        ("Run several training configurations back to back, loading the frozen models only once."
+         " All arguments other than `--sweep_config` are passed to train.py and used as the base"
+         " configuration of every run."))
+    parser.add_argument(
+        "--sweep_config",
+        type=str,
+        required=True,
+        help=
+        ('A JSON file with a `"grid"` mapping train.py argument names to lists of values, whose'
+         ' cartesian product is run, and/or a `"configs"` list of argument overrides run in order'
+         " before the grid."),
+    )
+    sweep_args, train_args = parser.parse_known_args()
+    return sweep_args, parse_args(train_args)
+
+
+def build_runs(sweep_config):
+    """Return the list of argument overrides of every run in the sweep."""
+    runs = list(sweep_config.get("configs", []))
+    grid = sweep_config.get("grid", {})
+    if grid:
+        keys = list(grid)
+        for values in itertools.product(*(grid[key] for key in keys)):
+            runs.append(dict(zip(keys, values)))
+    return runs or [{}]
+
+
+def run_name(overrides, index):
+    """Name of the output directory of a run, from its overrides."""
+    if not overrides:
+        return f"run-{index}"
+    # path separators in the values would nest the directory or move it out of `output_dir`
+    return "-".join(f"{key}={PATH_SEPARATORS.sub('_', str(value))}"
+                    for key, value in overrides.items())
+
+
+def main():
+    sweep_args, base_args = parse_sweep_args()
+    with open(sweep_args.sweep_config) as f:
+        runs = build_runs(json.load(f))
+
+    for overrides in runs:
+        for key in overrides:
+            if not hasattr(base_args, key):
+                raise ValueError(f"Unknown train.py argument `{key}` in sweep.")
+            if key in MODEL_ARGS:
+                raise ValueError(
+                    f"`{key}` cannot vary within a sweep, as the models are loaded only once."
+                )
+            if key in PROCESS_ARGS:
+                raise ValueError(
+                    f"`{key}` cannot vary within a sweep, as all runs share the accelerator state of the process."
+                )
+
+    models = load_models(base_args)
+    tokenizer, _, text_encoder, _, _ = models
+    placeholder_token_ids, initializer_token_ids = add_placeholder_tokens(
+        tokenizer, text_encoder, base_args)
+
+    for index, overrides in enumerate(runs):
+        args = copy.deepcopy(base_args)
+        for key, value in overrides.items():
+            setattr(args, key, value)
+        args.output_dir = os.path.join(base_args.output_dir,
+                                       run_name(overrides, index))
+        print(f"Sweep run {index + 1}/{len(runs)}: {args.output_dir}")
+
+        # the workers of persistent dataloaders would outlive the run
+        train(args,
+              models,
+              placeholder_token_ids,
+              initializer_token_ids,
+              persistent_workers=False)
+
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# `--help` only parses arguments, so it may cost little more than the module level
+# imports of train.py; accelerate, diffusers or transformers would each add about a second
+BASELINE_IMPORTS = "import numpy, PIL.Image, torch, tqdm.auto"
+HELP_BUDGET_SECONDS = 0.6
+
+
+def run_python(*args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, *args],
+                            cwd=ROOT,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    return time.perf_counter() - start, result.stdout
+
+
+def test_help_stays_within_import_budget():
+    baseline = min(run_python("-c", BASELINE_IMPORTS)[0] for _ in range(3))
+    elapsed = min(run_python("train.py", "--help")[0] for _ in range(3))
+    assert elapsed < baseline + HELP_BUDGET_SECONDS, (
+        f"`train.py --help` took {elapsed:.2f}s, its imports {baseline:.2f}s")
+
+
+def test_import_does_not_load_training_libraries():
+    _, stdout = run_python(
+        "-c", "import sys, train; print(*(m for m in "
+        "('accelerate', 'diffusers', 'transformers') if m in sys.modules))")
+    assert stdout.strip() == ""
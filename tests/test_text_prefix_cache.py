@@ -0,0 +1,59 @@
+import pytest
+import torch
+from transformers import CLIPTextConfig, CLIPTextModel
+
+from train import TextPrefixCache
+
+PLACEHOLDER_ID = 90
+
+
+@pytest.fixture
+def text_model():
+    torch.manual_seed(0)
+    config = CLIPTextConfig(vocab_size=100,
+                            hidden_size=32,
+                            intermediate_size=64,
+                            num_hidden_layers=2,
+                            num_attention_heads=4,
+                            max_position_embeddings=16)
+    return CLIPTextModel(config).text_model.eval()
+
+
+def templates():
+    # "<bos> cat <R> chair ...", with the placeholder at different positions
+    ids = torch.randint(1, 80, (4, 16))
+    for row, position in enumerate([2, 5, 2, 15]):
+        ids[row, position] = PLACEHOLDER_ID
+    return ids
+
+
+def test_matches_text_model(text_model):
+    template_ids = templates()
+    cache = TextPrefixCache(text_model, template_ids, [PLACEHOLDER_ID])
+    assert cache.prefix_lengths.tolist() == [2, 5, 2, 15]
+
+    # the cache must not depend on the learned embedding
+    with torch.no_grad():
+        text_model.embeddings.token_embedding.weight[PLACEHOLDER_ID] += 1
+    template_index = torch.tensor([3, 1, 0, 1, 2])
+    input_ids = template_ids[template_index]
+    with torch.no_grad():
+        expected = text_model(input_ids)[0]
+    torch.testing.assert_close(cache(input_ids, template_index),
+                               expected,
+                               atol=1e-5,
+                               rtol=1e-5)
+
+
+def test_learned_embedding_gradients_match(text_model):
+    template_ids = templates()
+    cache = TextPrefixCache(text_model, template_ids, [PLACEHOLDER_ID])
+    weight = text_model.embeddings.token_embedding.weight
+    template_index = torch.tensor([1, 0, 3])
+    input_ids = template_ids[template_index]
+
+    text_model(input_ids)[0].square().sum().backward()
+    expected = weight.grad[PLACEHOLDER_ID].clone()
+    weight.grad = None
+    cache(input_ids, template_index).square().sum().backward()
+    torch.testing.assert_close(weight.grad[PLACEHOLDER_ID], expected)
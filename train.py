@@ -1,37 +1,33 @@
 import argparse
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import itertools
 import json
 import logging
 import math
+import mmap
 import os
 import random
+import shutil
+import tempfile
+import time
 from pathlib import Path
 from typing import Optional
-import pdb
 import torch.nn as nn
-import diffusers
 import numpy as np
 import PIL
 import torch
 import torch.nn.functional as F
 import torch.utils.checkpoint
-import transformers
-from accelerate import Accelerator
-from accelerate.logging import get_logger
-from accelerate.utils import set_seed
-from diffusers import (AutoencoderKL, DDPMScheduler, DiffusionPipeline,
-                       DPMSolverMultistepScheduler, StableDiffusionPipeline,
-                       UNet2DConditionModel)
-from diffusers.optimization import get_scheduler
-from diffusers.utils import check_min_version, is_wandb_available
-from diffusers.utils.import_utils import is_xformers_available
-from huggingface_hub import HfFolder, Repository, create_repo, whoami
+# diffusers, transformers, accelerate and huggingface_hub are imported where they are
+# used, so that the arguments are parsed and validated without waiting for them
 # TODO: remove and import from diffusers.utils when the new version of diffusers is released
 from packaging import version
 from PIL import Image
 from torch.utils.data import Dataset
-from torchvision import transforms
 from tqdm.auto import tqdm
-from transformers import CLIPTextModel, CLIPTokenizer
 
 from templates.relation_words import relation_words
 from templates.stop_words import stop_words
@@ -53,11 +49,104 @@ class Discriminator(nn.Module):
             nn.BatchNorm2d(512),
             nn.LeakyReLU(0.2, inplace=True),
             nn.Conv2d(512, 1, kernel_size=4, stride=1, padding=0),  # 输出: (1, 1, 1)
-            nn.Sigmoid()
         )
 
-    def forward(self, x):
-        return self.model(x).view(-1)  # 返回形状: (batch_size,)
+    def forward(self, x, split_sizes=None):
+        """Logits of `x`, whose parts of sizes `split_sizes` BatchNorm normalizes separately."""
+        # latents of other sizes than 64x64 (aspect ratio buckets, progressive resolution):
+        # small ones are upsampled so that every strided conv has an input, and the last
+        # feature map is pooled to the 4x4 the final conv expects
+        if min(x.shape[-2:]) < 16:
+            x = F.interpolate(x, size=(max(x.shape[-2], 16), max(x.shape[-1], 16)))
+        for layer in self.model[:-1]:
+            if split_sizes is not None and isinstance(layer, nn.BatchNorm2d):
+                x = torch.cat([layer(part) for part in x.split(split_sizes)])
+            else:
+                x = layer(x)
+        if x.shape[-2:] != (4, 4):
+            x = F.adaptive_avg_pool2d(x, 4)
+        return self.model[-1](x).view(-1)  # 返回 logits, 形状: (batch_size,)
+
+
+def discriminator_loss(discriminator, real, fake):
+    """Summed BCE of the discriminator on real and detached fake latents, in one batched forward.
+
+    Real and fake latents keep separate BatchNorm statistics, as in two forwards.
+    """
+    logits = discriminator(
+        torch.cat([real, fake]),
+        split_sizes=[real.shape[0], fake.shape[0]]).float()
+    labels = torch.cat([
+        torch.ones(real.shape[0], device=logits.device),
+        torch.zeros(fake.shape[0], device=logits.device)
+    ])
+    return F.binary_cross_entropy_with_logits(
+        logits, labels, reduction="sum") / 2
+
+
+def generator_loss(discriminator, fake):
+    """Summed BCE pushing the discriminator to classify `fake` as real."""
+    # only `fake` needs gradients, skip the ones of the discriminator weights, and normalize
+    # with the running statistics, which only the discriminator step updates
+    training = discriminator.training
+    discriminator.requires_grad_(False)
+    discriminator.eval()
+    logits = discriminator(fake).float()
+    discriminator.train(training)
+    discriminator.requires_grad_(True)
+    return F.binary_cross_entropy_with_logits(
+        logits, torch.ones_like(logits), reduction="sum")
+
+
+class TrainableTokenEmbedding(nn.Module):
+    """Frozen token embedding with the rows of `token_ids` spliced in as a small trainable parameter.
+
+    Gradients, optimizer state and the restore step then scale with the number of learned
+    tokens instead of the vocabulary size.
+    """
+
+    def __init__(self, base_embedding, token_ids):
+        super(TrainableTokenEmbedding, self).__init__()
+        self.base = base_embedding
+        self.base.requires_grad_(False)
+
+        token_ids = torch.as_tensor(token_ids, dtype=torch.long)
+        row_lookup = torch.full((base_embedding.num_embeddings, ),
+                                -1,
+                                dtype=torch.long)
+        row_lookup[token_ids] = torch.arange(len(token_ids))
+        self.register_buffer("token_ids", token_ids)
+        self.register_buffer("row_lookup", row_lookup)
+        self.trainable_rows = nn.Parameter(
+            base_embedding.weight.detach()[token_ids].clone())
+
+    @property
+    def num_embeddings(self):
+        return self.base.num_embeddings
+
+    @property
+    def embedding_dim(self):
+        return self.base.embedding_dim
+
+    @property
+    def weight(self):
+        """Full embedding matrix with the trainable rows merged in."""
+        return self.base.weight.index_put((self.token_ids, ),
+                                          self.trainable_rows)
+
+    def to_embedding(self):
+        """Return a plain `nn.Embedding` holding the merged weights."""
+        embedding = nn.Embedding(self.num_embeddings, self.embedding_dim)
+        embedding.weight.data.copy_(self.weight.detach())
+        return embedding.to(self.base.weight.device)
+
+    def forward(self, input_ids):
+        embeds = self.base(input_ids)
+        rows = self.row_lookup[input_ids]
+        trainable_embeds = self.trainable_rows[rows.clamp(min=0)]
+        return torch.where((rows >= 0).unsqueeze(-1),
+                           trainable_embeds.to(embeds.dtype), embeds)
+
 
 if version.parse(version.parse(
         PIL.__version__).base_version) >= version.parse("9.1.0"):
@@ -78,10 +167,26 @@ else:
     }
 # ------------------------------------------------------------------------------
 
-# Will error if the minimal version of diffusers is not installed. Remove at your own risks.
-check_min_version("0.13.0.dev0")
 
-logger = get_logger(__name__)
+class MainProcessLogger(logging.LoggerAdapter):
+    """`accelerate.logging.get_logger` that only imports accelerate once it logs.
+
+    Logs only on the main process unless called with `main_process_only=False`.
+    """
+
+    def log(self, level, msg, *args, main_process_only=True, **kwargs):
+        from accelerate.state import PartialState
+
+        if not self.isEnabledFor(level):
+            return
+        if main_process_only and not PartialState().is_main_process:
+            return
+        msg, kwargs = self.process(msg, kwargs)
+        kwargs.setdefault("stacklevel", 2)
+        self.logger.log(level, msg, *args, **kwargs)
+
+
+logger = MainProcessLogger(logging.getLogger(__name__), {})
 
 IMG_EXTENSIONS = ('.jpg', '.JPG', '.jpeg', '.JPEG', '.png', '.PNG', '.ppm',
                   '.PPM', '.bmp', '.BMP', '.tif')
@@ -92,18 +197,16 @@ def is_image_file(filename):
     return filename.endswith(IMG_EXTENSIONS)
 
 
-def save_progress(text_encoder, placeholder_token_id, accelerator, args,
-                  save_path):
+def save_progress(text_encoder, placeholder_token_id, placeholder_token,
+                  accelerator, save_path):
     logger.info("Saving embeddings")
     learned_embeds = accelerator.unwrap_model(
         text_encoder).get_input_embeddings().weight[placeholder_token_id]
-    learned_embeds_dict = {
-        args.placeholder_token: learned_embeds.detach().cpu()
-    }
+    learned_embeds_dict = {placeholder_token: learned_embeds.detach().cpu()}
     torch.save(learned_embeds_dict, save_path)
 
 
-def parse_args():
+def parse_args(input_args=None):
     parser = argparse.ArgumentParser(
         description="Simple example of a training script.")
     parser.add_argument(
@@ -124,7 +227,8 @@ def parse_args():
         default=None,
         required=True,
         help=
-        "Path to pretrained model or model identifier from huggingface.co/models.",
+        ("Path to pretrained model or model identifier from huggingface.co/models. `tiny` creates"
+         " a randomly initialized tiny model locally, for smoke tests with `--resolution 128`."),
     )
     parser.add_argument(
         "--revision",
@@ -139,6 +243,12 @@ def parse_args():
         type=float,
         default=0.001,
     )
+    parser.add_argument(
+        "--discriminator_update_steps",
+        type=int,
+        default=1,
+        help="Update the discriminator every X steps (n_critic).",
+    )
     parser.add_argument(
         "--tokenizer_name",
         type=str,
@@ -148,24 +258,41 @@ def parse_args():
     parser.add_argument(
         "--train_data_dir",
         type=str,
+        nargs="+",
         default=None,
         required=True,
         help=
-        "The folder that contains the exemplar images (and coarse descriptions) of the specific relation."
+        ("The folder that contains the exemplar images (and coarse descriptions) of the specific relation."
+         " Pass several folders to learn one relation per folder in a single run."),
+    )
+    parser.add_argument(
+        "--train_data_shard",
+        type=str,
+        nargs="+",
+        default=None,
+        help=
+        ("A preprocessed shard of `train_data_dir` written by preprocess.py. Images and templates are"
+         " memory-mapped from it instead of being decoded and tokenized on every run. One per"
+         " `train_data_dir` when several relations are trained."),
     )
     parser.add_argument(
         "--placeholder_token",
         type=str,
+        nargs="+",
         default=None,
         required=True,
-        help="A token to use as a placeholder for the relation.",
+        help=
+        "A token to use as a placeholder for the relation. One per `train_data_dir`.",
     )
     parser.add_argument(
         "--initializer_token",
         type=str,
+        nargs="+",
         default=None,
         required=True,
-        help="A token to use as initializer word.")
+        help=
+        ("A token to use as initializer word. Either one shared by all relations or one per"
+         " `train_data_dir`."))
     parser.add_argument(
         "--repeats",
         type=int,
@@ -195,6 +322,36 @@ def parse_args():
         "--center_crop",
         action="store_true",
         help="Whether to center crop images before resizing to resolution.")
+    parser.add_argument(
+        "--aspect_ratio_buckets",
+        action="store_true",
+        help=
+        ("Resize and crop every exemplar to the bucket of its aspect ratio, with about `resolution`²"
+         " pixels, instead of a square, and batch exemplars of the same bucket together."),
+    )
+    parser.add_argument(
+        "--bucket_step",
+        type=int,
+        default=64,
+        help=
+        "Bucket sides, and the sides of `--progressive_resolution` batches, are multiples of this.",
+    )
+    parser.add_argument(
+        "--bucket_max_ratio",
+        type=float,
+        default=2.0,
+        help="Largest aspect ratio of the buckets.",
+    )
+    parser.add_argument(
+        "--progressive_resolution",
+        type=str,
+        nargs="+",
+        default=None,
+        help=
+        ("Train at lower resolutions first, as `RESOLUTION:UNTIL_STEP` pairs, e.g. `256:300 384:600`"
+         " trains at 256 until step 300, at 384 until step 600 and at `--resolution` after."
+         " Batches are downscaled on the device before the vae."),
+    )
     parser.add_argument(
         "--train_batch_size",
         type=int,
@@ -251,10 +408,23 @@ def parse_args():
     parser.add_argument(
         "--dataloader_num_workers",
         type=int,
-        default=0,
+        default=None,
         help=
         ("Number of subprocesses to use for data loading. 0 means that the data will be loaded in the main process."
-         ),
+         " Defaults to 0, or up to 4 with `--dataloader_throughput_mode`."),
+    )
+    parser.add_argument(
+        "--dataloader_throughput_mode",
+        action="store_true",
+        help=
+        ("Load exemplars as uint8 in persistent workers, prefetch pinned batches and copy them"
+         " without blocking, then normalize and flip them on the device."),
+    )
+    parser.add_argument(
+        "--dataloader_prefetch_factor",
+        type=int,
+        default=2,
+        help="Number of batches loaded in advance by each dataloader worker.",
     )
     parser.add_argument(
         "--adam_beta1",
@@ -310,6 +480,24 @@ def parse_args():
             "between fp16 and bf16 (bfloat16). Bf16 requires PyTorch >= 1.10."
             "and an Nvidia Ampere GPU."),
     )
+    parser.add_argument(
+        "--num_threads",
+        type=int,
+        default=None,
+        help="Number of threads used by torch on CPU.",
+    )
+    parser.add_argument(
+        "--channels_last",
+        action="store_true",
+        help="Keep the unet and vae weights in channels-last memory format.",
+    )
+    parser.add_argument(
+        "--cpu_performance_mode",
+        action="store_true",
+        help=
+        ("Settings for fast training on CPU: bf16 autocast unless `--mixed_precision` is given,"
+         " channels-last weights and one torch thread per CPU core available to the process."),
+    )
     parser.add_argument(
         "--allow_tf32",
         action="store_true",
@@ -350,6 +538,54 @@ def parse_args():
          " `args.validation_prompt` multiple times: `args.num_validation_images`"
          " and logging the images."),
     )
+    parser.add_argument(
+        "--logging_steps",
+        type=int,
+        default=10,
+        help=
+        ("Log the metrics, averaged over the last X steps, every X steps. They are kept on"
+         " device in between, so that logging does not synchronize every step."),
+    )
+    parser.add_argument(
+        "--log_stage_times",
+        action="store_true",
+        help=
+        "Time each stage of the training step with device events and log the mean times.",
+    )
+    parser.add_argument(
+        "--log_stage_memory",
+        action="store_true",
+        help=
+        "Log the peak GPU memory allocated during each stage of the training step.",
+    )
+    parser.add_argument(
+        "--profile_start_step",
+        type=int,
+        default=None,
+        help=
+        ("Record the training steps after this step with `torch.profiler`, up to"
+         " `--profile_stop_step`. The trace is written to `output_dir/profile`."),
+    )
+    parser.add_argument(
+        "--profile_stop_step",
+        type=int,
+        default=None,
+        help="Last training step recorded with `torch.profiler`.",
+    )
+    parser.add_argument(
+        "--validation_steps",
+        type=int,
+        default=None,
+        help=
+        "Run validation every X training steps instead of every `--validation_epochs` epochs.",
+    )
+    parser.add_argument(
+        "--validation_in_background",
+        action="store_true",
+        help=
+        ("Run validation on a background thread (and CUDA stream) while training continues, the"
+         " images are logged once they are ready."),
+    )
     parser.add_argument(
         "--local_rank",
         type=int,
@@ -372,10 +608,35 @@ def parse_args():
          ' `--checkpointing_steps`, or `"latest"` to automatically select the last available checkpoint.'
          ),
     )
+    parser.add_argument(
+        "--lightweight_checkpoints",
+        action="store_true",
+        default=False,
+        help=
+        ("Save checkpoints with only the learned token rows and their optimizer moments, the"
+         " discriminators, the lr scheduler, RNG states and the sampler seed, instead of the full"
+         " text encoder and optimizer state."),
+    )
     parser.add_argument(
         "--enable_xformers_memory_efficient_attention",
         action="store_true",
         help="Whether or not to use xformers.")
+    parser.add_argument(
+        "--attention_slicing",
+        action="store_true",
+        help=
+        ("Compute the unet attention a few heads at a time, which lowers its peak memory when the"
+         " memory efficient kernels of torch's scaled_dot_product_attention are unavailable."),
+    )
+    parser.add_argument(
+        "--low_memory",
+        action="store_true",
+        help=
+        ("Settings for the lowest accelerator memory: `--compact_embeddings`, so that no copy of"
+         " the embedding matrix is kept, `--cache_latents` with the vae moved off the accelerator (or"
+         " only its decoder, when the latents can't be cached), `--attention_slicing` without"
+         " scaled_dot_product_attention, and `--log_stage_memory`."),
+    )
 
     parser.add_argument(
         "--importance_sampling",
@@ -383,6 +644,15 @@ def parse_args():
         default=False,
         help="Relation-Focal Importance Sampling",
     )
+    parser.add_argument(
+        "--timestep_sampling",
+        type=str,
+        default="multinomial",
+        choices=["multinomial", "stratified", "antithetic"],
+        help=
+        ("How training timesteps are drawn from the (uniform or importance sampling) distribution:"
+         " independent draws, one draw per stratum of the CDF, or antithetic pairs."),
+    )
     parser.add_argument(
         "--denoise_loss_weight",
         type=float,
@@ -413,8 +683,49 @@ def parse_args():
         default=0.5,
         help="The skewness (alpha) of the Importance Sampling Function",
     )
+    parser.add_argument(
+        "--compact_embeddings",
+        action="store_true",
+        default=False,
+        help=
+        ("Only make the placeholder token row(s) a trainable parameter, spliced into the frozen"
+         " embedding lookup, instead of optimizing the full vocabulary embedding matrix."),
+    )
+    parser.add_argument(
+        "--cache_latents",
+        action="store_true",
+        default=False,
+        help=
+        ("Encode every exemplar with the VAE once before training and sample latents from the cached"
+         " distribution instead of running the VAE encoder every step. The VAE is moved off the"
+         " accelerator while training."),
+    )
+    parser.add_argument(
+        "--cache_text_prefix",
+        action="store_true",
+        help=
+        ("Compute the text encoder states of the template tokens before the placeholder token once,"
+         " and only run the text encoder from the placeholder token on every step."),
+    )
+    parser.add_argument(
+        "--latent_cache_dir",
+        type=str,
+        default=None,
+        help=
+        ("Directory used to persist the latent cache across runs. Entries are keyed by image content,"
+         " resolution, center cropping and VAE revision. Only used with `--cache_latents`."),
+    )
+    parser.add_argument(
+        "--weight_cache_dir",
+        type=str,
+        default=None,
+        help=
+        ("Keep copies of the frozen unet and vae weights cast to the `--mixed_precision` dtype in"
+         " this directory, and memory-map them instead of loading and casting the pretrained weights."
+         " With torch>=2.1, runs on one host using the same copy share its memory."),
+    )
 
-    args = parser.parse_args()
+    args = parser.parse_args(input_args)
     print("Args:", vars(args))
     env_local_rank = int(os.environ.get("LOCAL_RANK", -1))
     if env_local_rank != -1 and env_local_rank != args.local_rank:
@@ -423,9 +734,151 @@ def parse_args():
     if args.train_data_dir is None:
         raise ValueError("You must specify a train data directory.")
 
+    num_relations = len(args.train_data_dir)
+    if len(args.placeholder_token) != num_relations:
+        raise ValueError(
+            "Please pass one `placeholder_token` per `train_data_dir`.")
+    if len(set(args.placeholder_token)) != num_relations:
+        raise ValueError("The placeholder tokens must be distinct.")
+    if len(args.initializer_token) == 1:
+        args.initializer_token = args.initializer_token * num_relations
+    elif len(args.initializer_token) != num_relations:
+        raise ValueError(
+            "Please pass one `initializer_token`, or one per `train_data_dir`."
+        )
+    if args.train_data_shard is not None and len(
+            args.train_data_shard) != num_relations:
+        raise ValueError(
+            "Please pass one `train_data_shard` per `train_data_dir`.")
+    if len({os.path.basename(os.path.normpath(data_dir))
+            for data_dir in args.train_data_dir}) != num_relations:
+        # they name the output sub folders of the relations
+        raise ValueError(
+            "The `train_data_dir` folders must have distinct names.")
+    for r, data_dir in enumerate(args.train_data_dir):
+        # checked here, so that a bad config fails before the models are imported and loaded
+        if args.train_data_shard is not None:
+            if not os.path.isfile(args.train_data_shard[r]):
+                raise ValueError(
+                    f"`train_data_shard` {args.train_data_shard[r]} does not exist."
+                )
+        elif not os.path.isfile(os.path.join(data_dir, "text.json")):
+            raise ValueError(
+                f"`train_data_dir` {data_dir} has no `text.json` with the templates of its images."
+            )
+    if args.aspect_ratio_buckets and args.train_data_shard is not None:
+        raise ValueError(
+            "`aspect_ratio_buckets` needs the exemplar images, not `train_data_shard`."
+        )
+    if args.progressive_resolution is not None:
+        schedule = []
+        for stage in args.progressive_resolution:
+            try:
+                resolution, until_step = map(int, stage.split(":"))
+            except ValueError:
+                raise ValueError(
+                    f"Invalid `progressive_resolution` stage {stage}, expected `RESOLUTION:UNTIL_STEP`."
+                )
+            if resolution >= args.resolution:
+                raise ValueError(
+                    "`progressive_resolution` resolutions must be smaller than `resolution`."
+                )
+            if schedule and until_step <= schedule[-1][1]:
+                raise ValueError(
+                    "`progressive_resolution` steps must be increasing.")
+            schedule.append([resolution, until_step])
+        args.progressive_resolution = schedule
+    if args.cache_latents and (args.aspect_ratio_buckets
+                               or args.progressive_resolution is not None):
+        raise ValueError(
+            "`cache_latents` encodes square full resolution exemplars, it can't be used with"
+            " `aspect_ratio_buckets` or `progressive_resolution`.")
+    if args.cache_text_prefix and args.gradient_checkpointing:
+        raise ValueError(
+            "`cache_text_prefix` runs the text encoder layers itself, without `gradient_checkpointing`."
+        )
+    if (args.profile_start_step is None) != (args.profile_stop_step is None):
+        raise ValueError(
+            "Please pass both `profile_start_step` and `profile_stop_step`.")
+    if (args.profile_start_step is not None
+            and args.profile_start_step >= args.profile_stop_step):
+        raise ValueError(
+            "`profile_start_step` must be smaller than `profile_stop_step`.")
+
+    if args.dataloader_num_workers is None:
+        args.dataloader_num_workers = 0
+        if args.dataloader_throughput_mode:
+            args.dataloader_num_workers = min(4, os.cpu_count() or 1)
+
+    if args.low_memory:
+        args.compact_embeddings = True
+        args.log_stage_memory = True
+        if not hasattr(F, "scaled_dot_product_attention"):
+            args.attention_slicing = True
+        # bucketed or downscaled exemplars aren't cached, only the vae decoder is offloaded then
+        if not (args.aspect_ratio_buckets
+                or args.progressive_resolution is not None):
+            args.cache_latents = True
+
+    if args.cpu_performance_mode:
+        if args.mixed_precision == "no":
+            args.mixed_precision = "bf16"
+        args.channels_last = True
+        if args.num_threads is None:
+            # the cores the process may run on, which can be fewer than the machine has
+            args.num_threads = (len(os.sched_getaffinity(0)) if hasattr(
+                os, "sched_getaffinity") else os.cpu_count())
+
     return args
 
 
+class ImageShard:
+    """Read-only view of a preprocessed shard written by `preprocess.py`.
+
+    The file holds a magic string, the length of a JSON header and the header itself,
+    followed by the raw arrays listed in `header["arrays"]`, whose offsets are relative
+    to the first `ALIGNMENT`-aligned byte after the header. Arrays are memory-mapped
+    lazily, so every dataloader worker shares the same page-cached copy.
+    """
+
+    MAGIC = b"RVSHARD1"
+    ALIGNMENT = 64
+
+    @classmethod
+    def data_offset(cls, header_length):
+        end = len(cls.MAGIC) + 8 + header_length
+        return -(-end // cls.ALIGNMENT) * cls.ALIGNMENT
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            if f.read(len(self.MAGIC)) != self.MAGIC:
+                raise ValueError(f"{path} is not a ReVersion image shard.")
+            header_length = int.from_bytes(f.read(8), "little")
+            self.header = json.loads(f.read(header_length).decode("utf-8"))
+        self._data_offset = self.data_offset(header_length)
+        self._arrays = None
+
+    def __getstate__(self):
+        # never pickle the memory maps into worker processes, re-open them there
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        return state
+
+    def __getitem__(self, name):
+        if self._arrays is None:
+            self._arrays = {
+                key: np.memmap(
+                    self.path,
+                    dtype=spec["dtype"],
+                    mode="r",
+                    offset=self._data_offset + spec["offset"],
+                    shape=tuple(spec["shape"]))
+                for key, spec in self.header["arrays"].items()
+            }
+        return self._arrays[name]
+
+
 class ReVersionDataset(Dataset):
 
     def __init__(
@@ -441,13 +894,12 @@ class ReVersionDataset(Dataset):
         center_crop=False,
         relation_words=None,
         num_positives=1,
+        shard_path=None,
+        relation_index=0,
+        buckets=None,
     ):
         self.data_root = data_root
-
-        # read per image templates
-        local_f = open(os.path.join(data_root, 'text.json'))
-        self.templates = json.load(local_f)
-        print(f'self.templates={self.templates}')
+        self.relation_index = relation_index
 
         self.tokenizer = tokenizer
         self.size = size
@@ -459,18 +911,76 @@ class ReVersionDataset(Dataset):
         self.relation_words = relation_words
         self.num_positives = num_positives
 
-        # record image paths
-        self.image_paths = []
-        for file_path in os.listdir(self.data_root):
-            # if file_path != 'text.json':
-
-            if is_image_file(file_path):
-                self.image_paths.append(
-                    os.path.join(self.data_root, file_path))
+        self.shard = None
+        if shard_path is not None:
+            self.shard = ImageShard(shard_path)
+            self._check_shard()
+            self.image_paths = [
+                os.path.join(self.data_root, image_name)
+                for image_name in self.shard.header["image_names"]
+            ]
+            self.template_ids = torch.from_numpy(
+                np.array(self.shard["template_ids"], dtype=np.int64))
+            self.template_ranges = np.array(self.shard["template_ranges"])
+        else:
+            # read per image templates
+            local_f = open(os.path.join(data_root, 'text.json'))
+            self.templates = json.load(local_f)
+            logger.info(f"Templates of {data_root}: {self.templates}")
+
+            # record image paths
+            self.image_paths = []
+            for file_path in os.listdir(self.data_root):
+                # if file_path != 'text.json':
+
+                if is_image_file(file_path):
+                    self.image_paths.append(
+                        os.path.join(self.data_root, file_path))
+
+            # pre-tokenize the coarse descriptions of every image into one packed table,
+            # rows [start, start + count) of `template_ids` belong to image `i`
+            template_ids = []
+            self.template_ranges = []
+            for image_path in self.image_paths:
+                image_name = image_path.split('/')[-1]
+                texts = [
+                    template.format(self.placeholder_token)
+                    for template in self.templates[image_name]
+                ]
+                self.template_ranges.append((len(template_ids), len(texts)))
+                template_ids.extend(
+                    self.tokenizer(
+                        texts,
+                        padding="max_length",
+                        truncation=True,
+                        max_length=self.tokenizer.model_max_length,
+                    ).input_ids)
+            self.template_ids = torch.tensor(template_ids, dtype=torch.long)
 
         self.num_images = len(self.image_paths)
         self._length = self.num_images
 
+        # (width, height) of the aspect ratio bucket of every image, see `aspect_ratio_buckets`
+        self.buckets = buckets
+        if buckets is not None:
+            if self.shard is not None:
+                raise ValueError(
+                    "Aspect ratio buckets need the exemplar images, shards only hold square crops."
+                )
+            self.image_buckets = []
+            for image_path in self.image_paths:
+                # only reads the image header
+                with Image.open(image_path) as image:
+                    self.image_buckets.append(
+                        nearest_bucket(image.size, buckets))
+
+        # token ids of every relation word, without bos/eos
+        if self.num_positives > 0:
+            self.relation_word_ids = [
+                self.tokenizer(word, add_special_tokens=False).input_ids
+                for word in self.relation_words
+            ]
+
         if set == "train":
             self._length = self.num_images * repeats
 
@@ -481,48 +991,54 @@ class ReVersionDataset(Dataset):
             "lanczos": PIL_INTERPOLATION["lanczos"],
         }[interpolation]
 
-        self.flip_transform = transforms.RandomHorizontalFlip(p=self.flip_p)
+        # set to False when latents are served from a precomputed cache
+        self.return_pixel_values = True
+        # set to True to return unflipped uint8 pixels, see `preprocess_pixels`
+        self.return_uint8 = False
 
     def __len__(self):
         return self._length
 
-    def __getitem__(self, i):
-        example = {}
-
-        # exemplar images
-        image_path = self.image_paths[i % self.num_images]
-        image = Image.open(image_path)
-        image_name = image_path.split('/')[-1]
+    def _check_shard(self):
+        header = self.shard.header
+        expected = {
+            "size": self.size,
+            "center_crop": self.center_crop,
+            "placeholder_token": self.placeholder_token,
+            "placeholder_token_id":
+            self.tokenizer.convert_tokens_to_ids(self.placeholder_token),
+            "vocab_size": len(self.tokenizer),
+            "model_max_length": self.tokenizer.model_max_length,
+        }
+        for key, value in expected.items():
+            if header[key] != value:
+                raise ValueError(
+                    f"Shard {self.shard.path} was written with {key}={header[key]}, but this run uses"
+                    f" {key}={value}. Please re-run preprocess.py.")
+
+    def image_bytes(self, index):
+        """Raw bytes identifying exemplar `index`: the image file, or its preprocessed pixels in a shard."""
+        if self.shard is not None:
+            return self.shard["pixels"][index].tobytes()
+        with open(self.image_paths[index], "rb") as f:
+            return f.read()
+
+    def load_pixels(self, index):
+        """Center-cropped and resized exemplar `index` as a (size, size, 3) uint8 array.
+
+        With aspect ratio buckets, the array is (height, width, 3) of the bucket of the image.
+        """
+        if self.shard is not None:
+            return self.shard["pixels"][index]
+
+        image = Image.open(self.image_paths[index])
 
         if not image.mode == "RGB":
             image = image.convert("RGB")
 
-        placeholder_string = self.placeholder_token
-
-        # coarse descriptions
-        text = random.choice(
-            self.templates[image_name]).format(placeholder_string)
-
-        example["input_ids"] = self.tokenizer(
-            text,
-            padding="max_length",
-            truncation=True,
-            max_length=self.tokenizer.model_max_length,
-            return_tensors="pt",
-        ).input_ids[0]
-
-        # randomly sample positive words for L_steer
-        if self.num_positives > 0:
-            positive_words = random.sample(
-                self.relation_words, k=self.num_positives)
-            positive_words_string = " ".join(positive_words)
-            example["positive_ids"] = self.tokenizer(
-                positive_words_string,
-                padding="max_length",
-                truncation=True,
-                max_length=self.tokenizer.model_max_length,
-                return_tensors="pt",
-            ).input_ids[0]
+        if self.buckets is not None:
+            return fit_to_bucket(image, self.image_buckets[index],
+                                 self.interpolation)
 
         # default to score-sde preprocessing
         img = np.array(image).astype(np.uint8)
@@ -543,18 +1059,201 @@ class ReVersionDataset(Dataset):
         image = image.resize((self.size, self.size),
                              resample=self.interpolation)
 
-        image = self.flip_transform(image)
-        image = np.array(image).astype(np.uint8)
-        image = (image / 127.5 - 1.0).astype(np.float32)
+        return np.array(image).astype(np.uint8)
+
+    def load_uint8(self, index):
+        """Exemplar `index` as a (3, size, size) uint8 tensor."""
+        return torch.from_numpy(np.array(self.load_pixels(index))).permute(
+            2, 0, 1)
+
+    def load_image(self, index):
+        """Load and preprocess the exemplar image at `index` as a (3, size, size) tensor in [-1, 1]."""
+        image = self.load_uint8(index)
+        # only drawn when flipping, so that data loading draws nothing from the torch RNG otherwise
+        if self.flip_p > 0 and torch.rand(1) < self.flip_p:
+            image = image.flip(-1)
 
-        example["pixel_values"] = torch.from_numpy(image).permute(2, 0, 1)
+        return image.float() / 127.5 - 1.0
+
+    def pack_ids(self, ids):
+        """Add bos/eos to `ids`, then truncate and pad to `model_max_length` like the tokenizer does."""
+        max_length = self.tokenizer.model_max_length
+        ids = [self.tokenizer.bos_token_id] + ids[:max_length - 2] + [
+            self.tokenizer.eos_token_id
+        ]
+        ids = ids + [self.tokenizer.pad_token_id] * (max_length - len(ids))
+        return torch.tensor(ids, dtype=torch.long)
+
+    def __getitem__(self, i):
+        example = {}
+        example["relation_index"] = self.relation_index
+
+        # exemplar images
+        image_index = i % self.num_images
+        example["image_index"] = image_index
+
+        # coarse descriptions
+        start, count = self.template_ranges[image_index]
+        template_index = start + random.randrange(count)
+        example["template_index"] = template_index
+        example["input_ids"] = self.template_ids[template_index]
+
+        # randomly sample positive words for L_steer
+        if self.num_positives > 0:
+            positive_words = random.sample(
+                self.relation_word_ids, k=self.num_positives)
+            example["positive_ids"] = self.pack_ids(
+                [token_id for word in positive_words for token_id in word])
+
+        if self.return_pixel_values:
+            example["pixel_values"] = (self.load_uint8(image_index)
+                                       if self.return_uint8 else
+                                       self.load_image(image_index))
 
         return example
 
 
+def aspect_ratio_buckets(resolution, step=64, max_ratio=2.0):
+    """(width, height) buckets with sides multiple of `step`, at most `resolution`² pixels
+    and an aspect ratio up to `max_ratio`, largest area first for each aspect ratio."""
+    buckets = {(resolution, resolution)}
+    for width in range(step, int(resolution * max_ratio) + 1, step):
+        height = resolution * resolution // width // step * step
+        if height >= step and max(width / height, height / width) <= max_ratio:
+            buckets.add((width, height))
+            buckets.add((height, width))
+    return sorted(buckets)
+
+
+def nearest_bucket(size, buckets):
+    """The bucket closest to the aspect ratio of an image of (width, height) `size`."""
+    ratio = math.log(size[0] / size[1])
+    return min(buckets,
+               key=lambda bucket:
+               (abs(math.log(bucket[0] / bucket[1]) - ratio), -bucket[0] * bucket[1]))
+
+
+def fit_to_bucket(image, bucket, resample):
+    """Resize `image` to cover the (width, height) `bucket` and center crop it to the bucket,
+    as a (height, width, 3) uint8 array."""
+    width, height = bucket
+    scale = max(width / image.width, height / image.height)
+    size = (max(width, round(image.width * scale)),
+            max(height, round(image.height * scale)))
+    image = image.resize(size, resample=resample)
+    left, top = (size[0] - width) // 2, (size[1] - height) // 2
+    image = image.crop((left, top, left + width, top + height))
+    return np.array(image).astype(np.uint8)
+
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """Batches of the indices drawn by `sampler` that share a bucket, e.g. the image shape.
+
+    A batch is yielded as soon as `batch_size` indices of its bucket are drawn, and the
+    incomplete batches at the end of the epoch. Batches only depend on the order of the
+    `ResumableSampler`, so training can resume at any batch through `set_position`.
+
+    With `num_processes` > 1, the batches are sharded between processes by accelerate,
+    which would complete them with indices of other buckets. The incomplete batches are
+    then filled with indices drawn earlier from their own bucket, and the first batches
+    repeated until every process gets as many.
+    """
+
+    def __init__(self, sampler, buckets, batch_size, num_processes=1):
+        self.sampler = sampler
+        self.buckets = buckets
+        self.batch_size = batch_size
+        self.num_processes = num_processes
+        self.start_batch = 0
+
+    def set_position(self, epoch, start_batch=0):
+        self.sampler.set_position(epoch)
+        self.start_batch = start_batch
+
+    def batches(self):
+        pending = {}
+        drawn = collections.defaultdict(list)
+        for index in self.sampler:
+            bucket = self.buckets[index]
+            drawn[bucket].append(index)
+            pending.setdefault(bucket, []).append(index)
+            if len(pending[bucket]) == self.batch_size:
+                yield pending.pop(bucket)
+        for bucket, batch in pending.items():
+            if self.num_processes > 1:
+                fill = itertools.cycle(drawn[bucket])
+                batch = batch + [
+                    next(fill) for _ in range(self.batch_size - len(batch))
+                ]
+            yield batch
+
+    def sharded_batches(self):
+        """`batches`, with the first ones repeated up to a multiple of `num_processes`."""
+        first_batches = []
+        num_batches = 0
+        for batch in self.batches():
+            if len(first_batches) < self.num_processes:
+                first_batches.append(batch)
+            num_batches += 1
+            yield batch
+        first_batches = itertools.cycle(first_batches)
+        while num_batches % self.num_processes:
+            num_batches += 1
+            yield next(first_batches)
+
+    def __iter__(self):
+        batches = self.sharded_batches()
+        for _ in range(self.start_batch):
+            next(batches, None)
+        return batches
+
+    def __len__(self):
+        num_batches = sum(
+            math.ceil(count / self.batch_size)
+            for count in collections.Counter(self.buckets).values())
+        return math.ceil(
+            num_batches / self.num_processes) * self.num_processes
+
+
+def progressive_scale(step, args):
+    """Scale of the training resolution at `step` of the `--progressive_resolution` schedule."""
+    for resolution, until_step in args.progressive_resolution or []:
+        if step < until_step:
+            return resolution / args.resolution
+    return 1.0
+
+
+def downscale_pixels(pixel_values, scale, step):
+    """Resize a batch of images by `scale`, rounding the sides to multiples of `step`."""
+    height, width = pixel_values.shape[-2:]
+    size = (max(step, round(height * scale / step) * step),
+            max(step, round(width * scale / step) * step))
+    if size == (height, width):
+        return pixel_values
+    return F.interpolate(
+        pixel_values.float(),
+        size=size,
+        mode="bilinear",
+        align_corners=False,
+        antialias=True).to(pixel_values.dtype)
+
+
+def preprocess_pixels(pixel_values, flip_p, dtype):
+    """Device side `ReVersionDataset.load_image` of a batch of uint8 `pixel_values`."""
+    pixel_values = (pixel_values.float() / 127.5 - 1.0).to(dtype)
+    if flip_p > 0:
+        flip = torch.rand(len(pixel_values),
+                          device=pixel_values.device) < flip_p
+        pixel_values = torch.where(flip[:, None, None, None],
+                                   pixel_values.flip(-1), pixel_values)
+    return pixel_values
+
+
 def get_full_repo_name(model_id: str,
                        organization: Optional[str] = None,
                        token: Optional[str] = None):
+    from huggingface_hub import HfFolder, whoami
+
     if token is None:
         token = HfFolder.get_token()
     if organization is None:
@@ -564,65 +1263,1312 @@ def get_full_repo_name(model_id: str,
         return f"{organization}/{model_id}"
 
 
-def calculate_steer_loss(token_embedding,
-                         input_ids,
-                         placeholder_token_id,
-                         stop_ids,
-                         special_ids,
-                         positive_ids,
-                         temperature=0.07):
-    """L_steer"""
-    # compute input embeddings
-    inputs_embeds = token_embedding(input_ids)  # (bs, 77, 768)
-    positive_embeds = token_embedding(positive_ids)
-
-    with torch.no_grad(
-    ):  # no gradients from positive and negative embeds, only from <R>
-        # compute entity embeds
-        stop_mask = torch.isin(
-            input_ids,
-            torch.tensor(stop_ids + special_ids +
-                         [placeholder_token_id]).cuda())  # (bs, 77)
-        negative_embds = inputs_embeds[~stop_mask]  # (num_stop_tokens, 768)
-
-        # remove bos and eos in positive embeddings
-        stop_mask = torch.isin(positive_ids,
-                               torch.tensor(special_ids).cuda())  # (bs, 77)
-        positive_embeds = positive_embeds[
-            ~stop_mask]  # (num_positive_tokens, 768), where num_positive_tokens = num_positives * bs
-
-        # stack positives and negatives as a pn_block
-        pn_embeds = torch.cat([positive_embeds, negative_embds], dim=0)
-        pn_embeds_normalized = F.normalize(
-            pn_embeds, p=2,
-            dim=1)  # (num_positive_tokens+num_negative_tokens, 768)
-
-    # compute relation embeds <R>
-    relation_mask = (input_ids[0] == placeholder_token_id)  # (77)
-    relation_embeds = inputs_embeds[0][relation_mask]  # (1, 768)
-    relation_embeds_normalized = F.normalize(relation_embeds, p=2, dim=1)
-
-    # compute Multi-Instance InfoNCE loss
-    logits = torch.einsum('nc,mc->nm',
-                          [relation_embeds_normalized, pn_embeds_normalized
-                           ])  # (1, num_positive_tokens+num_negative_tokens)
-
-    logits /= temperature
-    nominator = torch.logsumexp(logits[:, :positive_embeds.shape[0]], dim=1)
-    denominator = torch.logsumexp(logits, dim=1)
-
-    return torch.mean(denominator - nominator)
+class SteerLoss(nn.Module):
+    """L_steer, the Multi-Instance InfoNCE loss of Relation-Steering Contrastive Learning.
+
+    The stop/special/placeholder token lookups are precomputed as boolean vocabulary masks,
+    and the logits of every sample of the batch are computed at once. As in the loss
+    computed separately for each relation, the <R> embedding of a relation is contrasted
+    against the positive words and entity (negative) tokens pooled over all the samples of
+    that relation in the batch, and the losses of the relations are summed.
+    """
+
+    def __init__(self,
+                 vocab_size,
+                 stop_ids,
+                 special_ids,
+                 placeholder_token_ids,
+                 temperature=0.07):
+        super(SteerLoss, self).__init__()
+        self.temperature = temperature
+
+        special_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        special_mask[special_ids] = True
+        placeholder_mask = torch.zeros(vocab_size, dtype=torch.bool)
+        placeholder_mask[placeholder_token_ids] = True
+        # entity tokens are everything but stop words, special tokens and <R>
+        negative_mask = torch.ones(vocab_size, dtype=torch.bool)
+        negative_mask[stop_ids] = False
+        negative_mask[special_mask | placeholder_mask] = False
+
+        self.register_buffer("special_mask", special_mask)
+        self.register_buffer("placeholder_mask", placeholder_mask)
+        self.register_buffer("negative_mask", negative_mask)
+        self.register_buffer(
+            "placeholder_ids",
+            torch.as_tensor(placeholder_token_ids, dtype=torch.long))
+
+    def forward(self, token_embedding, input_ids, positive_ids):
+        # compute input embeddings
+        inputs_embeds = token_embedding(input_ids)  # (bs, 77, 768)
+
+        with torch.no_grad(
+        ):  # no gradients from positive and negative embeds, only from <R>
+            positive_embeds = token_embedding(positive_ids)  # (bs, 77, 768)
+
+            # stack positives (without bos/eos/padding) and negatives (entity tokens) as a pn_block
+            pn_embeds = torch.cat([positive_embeds, inputs_embeds.detach()],
+                                  dim=1)
+            pn_embeds_normalized = F.normalize(pn_embeds, p=2,
+                                               dim=2)  # (bs, 2 * 77, 768)
+            pn_valid = torch.cat([
+                ~self.special_mask[positive_ids],
+                self.negative_mask[input_ids]
+            ],
+                                 dim=1)  # (bs, 2 * 77)
+
+        # compute relation embeds <R>, at the first placeholder position of each sample
+        relation_mask = self.placeholder_mask[input_ids]  # (bs, 77)
+        has_relation = relation_mask.any(dim=1)
+        relation_position = relation_mask.int().argmax(dim=1)
+        sample_index = torch.arange(input_ids.shape[0], device=input_ids.device)
+        relation_embeds = inputs_embeds[sample_index,
+                                        relation_position]  # (bs, 768)
+        relation_embeds_normalized = F.normalize(
+            relation_embeds, p=2, dim=1)
+
+        # compute Multi-Instance InfoNCE loss
+        logits = torch.einsum(
+            'bc,bmc->bm',
+            [relation_embeds_normalized, pn_embeds_normalized
+             ])  # (bs, 2 * 77)
+        logits = logits / self.temperature
+        logits = logits.masked_fill(~pn_valid, float("-inf"))
+        sample_nominator = torch.logsumexp(
+            logits[:, :positive_ids.shape[1]], dim=1)  # (bs)
+        sample_denominator = torch.logsumexp(logits, dim=1)
+
+        # the samples of a relation share its <R> embedding, so pooling their positives and
+        # negatives is a logsumexp over their per-sample logsumexps
+        relation_samples = (input_ids[sample_index, relation_position] ==
+                            self.placeholder_ids.unsqueeze(1)) & has_relation
+        present = relation_samples.any(dim=1)  # (num_relations)
+        # relations without samples get finite dummy rows, zeroed below
+        excluded = ~relation_samples & present.unsqueeze(1)
+        nominator = torch.logsumexp(
+            sample_nominator.expand_as(relation_samples).masked_fill(
+                excluded, float("-inf")),
+            dim=1)
+        denominator = torch.logsumexp(
+            sample_denominator.expand_as(relation_samples).masked_fill(
+                excluded, float("-inf")),
+            dim=1)
+
+        return ((denominator - nominator) * present).sum()
+
+
+def latent_cache_key(dataset, index, args):
+    """Key of a cached latent: image content, preprocessing and VAE revision."""
+    hasher = hashlib.sha256()
+    hasher.update(dataset.image_bytes(index))
+    hasher.update(
+        f"{args.resolution}|{args.center_crop}|{args.pretrained_model_name_or_path}|{args.revision}"
+        .encode())
+    return hasher.hexdigest()
+
+
+def build_latent_cache(vae, dataset, args, device, dtype):
+    """Encode each exemplar once and return the mean and std of its latent distribution.
+
+    Returns two float32 tensors of shape (num_images, 4, h, w) on `device`, indexed by
+    the `image_index` of the dataset examples.
+    """
+    if dataset.flip_p > 0:
+        raise ValueError(
+            "Latent caching requires deterministic preprocessing, but flip_p > 0."
+        )
+    if args.latent_cache_dir is not None:
+        os.makedirs(args.latent_cache_dir, exist_ok=True)
+
+    means, stds = [], []
+    for index in range(dataset.num_images):
+        cache_path = None
+        if args.latent_cache_dir is not None:
+            cache_path = os.path.join(
+                args.latent_cache_dir,
+                f"{latent_cache_key(dataset, index, args)}.pt")
+
+        if cache_path is not None and os.path.exists(cache_path):
+            entry = torch.load(cache_path, map_location="cpu")
+        else:
+            pixel_values = dataset.load_image(index).unsqueeze(0).to(
+                device, dtype=dtype)
+            with torch.no_grad():
+                latent_dist = vae.encode(pixel_values).latent_dist
+            entry = {
+                "mean": latent_dist.mean[0].float().cpu(),
+                "std": latent_dist.std[0].float().cpu(),
+            }
+            if cache_path is not None:
+                torch.save(entry, cache_path)
+
+        means.append(entry["mean"])
+        stds.append(entry["std"])
+
+    return torch.stack(means).to(device), torch.stack(stds).to(device)
+
+
+class ResumableSampler(torch.utils.data.Sampler):
+    """Random sampler whose order only depends on `seed` and the epoch.
+
+    Training can then resume at any sample index through `set_position`, without
+    iterating over (and loading) the skipped batches.
+    """
+
+    def __init__(self, data_source, seed):
+        self.data_source = data_source
+        self.seed = seed
+        self.epoch = 0
+        self.start_index = 0
+
+    def set_position(self, epoch, start_index=0):
+        self.epoch = epoch
+        self.start_index = start_index
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        order = torch.randperm(len(self.data_source), generator=generator)
+        return iter(order[self.start_index:].tolist())
+
+    def __len__(self):
+        return len(self.data_source)
+
+
+TRAINING_STATE_NAME = "training_state.pt"
+
+
+def embedding_optimizer_state(optimizer, row_ids):
+    """State dict of the embedding optimizer with per-row moments restricted to `row_ids`.
+
+    `row_ids` is None when the optimized parameter only holds the learned rows.
+    """
+    state_dict = optimizer.state_dict()
+    if row_ids is not None:
+        state_dict["state"] = {
+            key: {
+                name: value[row_ids].cpu()
+                if torch.is_tensor(value) and value.dim() > 0 else value
+                for name, value in param_state.items()
+            }
+            for key, param_state in state_dict["state"].items()
+        }
+    return state_dict
+
+
+def load_embedding_optimizer_state(optimizer, state_dict, row_ids):
+    """Inverse of `embedding_optimizer_state`, the moments of other rows are zero."""
+    if row_ids is not None:
+        params = [
+            param for group in optimizer.param_groups
+            for param in group["params"]
+        ]
+        full_state = {}
+        for key, param_state in state_dict["state"].items():
+            param = params[key]
+            full_state[key] = {}
+            for name, value in param_state.items():
+                if torch.is_tensor(value) and value.dim() > 0:
+                    rows = value
+                    value = torch.zeros_like(param, dtype=rows.dtype)
+                    value[row_ids] = rows.to(param.device)
+                full_state[key][name] = value
+        state_dict = dict(state_dict, state=full_state)
+    optimizer.load_state_dict(state_dict)
+
+
+def save_training_state(save_path, accelerator, text_encoder,
+                        placeholder_token_ids, optimizer, lr_scheduler,
+                        discriminators, optimizers_D, d_grad_scaler,
+                        timestep_sampler, train_sampler):
+    """Save a lightweight checkpoint with only the learned state of the run.
+
+    Called by every process, the main process writes the random states of all of them.
+    """
+    # numpy arrays are stored as lists so that the checkpoint only holds plain types and tensors
+    np_state = np.random.get_state()
+    rng = {
+        "python": random.getstate(),
+        "numpy": (np_state[0], np_state[1].tolist()) + np_state[2:],
+        "torch": torch.get_rng_state(),
+        "cuda": torch.cuda.get_rng_state_all()
+        if torch.cuda.is_available() else None,
+        "timesteps": timestep_sampler.generator.get_state(),
+    }
+    if accelerator.num_processes > 1:
+        from accelerate.utils import gather_object
+        rng = gather_object([rng])
+    else:
+        rng = [rng]
+    if not accelerator.is_main_process:
+        return
+
+    token_embedding = accelerator.unwrap_model(
+        text_encoder).get_input_embeddings()
+    row_ids = None if isinstance(
+        token_embedding, TrainableTokenEmbedding) else placeholder_token_ids
+    state = {
+        "placeholder_token_ids": placeholder_token_ids,
+        "learned_embeds":
+        token_embedding.weight[placeholder_token_ids].detach().cpu(),
+        "optimizer": embedding_optimizer_state(optimizer, row_ids),
+        "lr_scheduler": lr_scheduler.state_dict(),
+        "discriminators": [d.state_dict() for d in discriminators],
+        "optimizers_D": [o.state_dict() for o in optimizers_D],
+        "d_grad_scaler": d_grad_scaler.state_dict(),
+        "sampler_seed": train_sampler.seed,
+        # one entry per process
+        "rng": rng,
+    }
+    os.makedirs(save_path, exist_ok=True)
+    torch.save(state, os.path.join(save_path, TRAINING_STATE_NAME))
+
+
+def load_training_state(checkpoint_dir, accelerator, text_encoder,
+                        placeholder_token_ids, optimizer, lr_scheduler,
+                        discriminators, optimizers_D, d_grad_scaler,
+                        timestep_sampler, train_sampler):
+    """Restore a checkpoint written by `save_training_state`."""
+    state = torch.load(
+        os.path.join(checkpoint_dir, TRAINING_STATE_NAME), map_location="cpu")
+    if state["placeholder_token_ids"] != placeholder_token_ids:
+        raise ValueError(
+            f"Checkpoint {checkpoint_dir} was saved for placeholder token ids"
+            f" {state['placeholder_token_ids']}, but this run uses {placeholder_token_ids}."
+        )
+
+    token_embedding = accelerator.unwrap_model(
+        text_encoder).get_input_embeddings()
+    with torch.no_grad():
+        if isinstance(token_embedding, TrainableTokenEmbedding):
+            token_embedding.trainable_rows.copy_(state["learned_embeds"])
+            row_ids = None
+        else:
+            token_embedding.weight[placeholder_token_ids] = state[
+                "learned_embeds"].to(token_embedding.weight.device)
+            row_ids = placeholder_token_ids
+    load_embedding_optimizer_state(optimizer, state["optimizer"], row_ids)
+    lr_scheduler.load_state_dict(state["lr_scheduler"])
+    for discriminator, d_state in zip(discriminators,
+                                      state["discriminators"]):
+        discriminator.load_state_dict(d_state)
+    for optimizer_D, o_state in zip(optimizers_D, state["optimizers_D"]):
+        optimizer_D.load_state_dict(o_state)
+    d_grad_scaler.load_state_dict(state["d_grad_scaler"])
+    train_sampler.seed = state["sampler_seed"]
+
+    rng = state["rng"]
+    if isinstance(rng, list):
+        rng = rng[accelerator.process_index % len(rng)]
+    random.setstate(rng["python"])
+    np.random.set_state((rng["numpy"][0], np.array(rng["numpy"][1],
+                                                   dtype=np.uint32)) +
+                        tuple(rng["numpy"][2:]))
+    torch.set_rng_state(rng["torch"])
+    if rng["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng["cuda"])
+    timestep_sampler.generator.set_state(rng["timesteps"])
+
+
+def relation_selectors(relation_index, num_relations):
+    """Yield `(r, selector)` indexing the samples of each relation present in the batch."""
+    if num_relations == 1:
+        yield 0, slice(None)
+        return
+    for r in range(num_relations):
+        selector = relation_index == r
+        if selector.any():
+            yield r, selector
+
+
+def broadcast_module(module):
+    """Copy the parameters and buffers of `module` from the main process to the others."""
+    import torch.distributed as dist
+
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=0)
+
+
+def average_buffers(module, num_processes):
+    """Average the floating point buffers of `module` over the processes.
+
+    Each process updates the BatchNorm running statistics of a discriminator with its own
+    batches, like DDP without SyncBatchNorm. Averaging them keeps one copy to checkpoint
+    and resume from. Integer buffers, like the batch counts, are copied from the main process.
+    """
+    import torch.distributed as dist
+
+    for buffer in module.buffers():
+        if buffer.is_floating_point():
+            dist.all_reduce(buffer.data)
+            buffer.data /= num_processes
+        else:
+            dist.broadcast(buffer.data, src=0)
+
+
+def average_gradients(parameter_groups, num_processes):
+    """Average the gradients of the groups of parameters over the processes, in one all-reduce.
+
+    Used instead of DDP for modules that a process may skip, like the discriminators of the
+    relations absent from its batch: their gradients count as zero. A group without
+    gradients on every process keeps none, so that its optimizer skips it as it does in a
+    single process.
+    """
+    import torch.distributed as dist
+
+    parameter_groups = [list(group) for group in parameter_groups]
+    parameters = [p for group in parameter_groups for p in group]
+    has_grad = torch.tensor(
+        [any(p.grad is not None for p in group) for group in parameter_groups],
+        dtype=torch.float32,
+        device=parameters[0].device)
+    flat = torch.cat([(p.grad if p.grad is not None else torch.zeros_like(p)
+                       ).flatten().float() for p in parameters] + [has_grad])
+    dist.all_reduce(flat)
+    has_grad = flat[len(flat) - len(parameter_groups):].tolist()
+    flat /= num_processes
+
+    offset = 0
+    for group, group_has_grad in zip(parameter_groups, has_grad):
+        for p in group:
+            grad = flat[offset:offset + p.numel()].view_as(p)
+            p.grad = grad.to(p.dtype) if group_has_grad else None
+            offset += p.numel()
 
 
 def importance_sampling_fn(t, max_t, alpha):
-    """Importance Sampling Function f(t)"""
-    return 1 / max_t * (1 - alpha * math.cos(math.pi * t / max_t))
+    """Importance Sampling Function f(t), `t` is a tensor of timesteps"""
+    return 1 / max_t * (1 - alpha * torch.cos(math.pi * t / max_t))
+
+
+class TimestepSampler:
+    """Draws training timesteps on `device` from a fixed distribution over all timesteps.
+
+    The distribution is uniform, or the cosine-skewed f(t) of Relation-Focal Importance
+    Sampling when `importance_sampling` is set. It is built once as a device tensor and
+    sampled with a seeded generator, either by independent multinomial draws, or through
+    its inverse CDF with stratified or antithetic uniforms.
+    """
+
+    def __init__(self,
+                 num_train_timesteps,
+                 device,
+                 importance_sampling=False,
+                 alpha=0.5,
+                 mode="multinomial",
+                 seed=None):
+        if mode not in ("multinomial", "stratified", "antithetic"):
+            raise ValueError(f"Unknown timestep sampling mode {mode}")
+        self.num_train_timesteps = num_train_timesteps
+        self.device = device
+        self.mode = mode
+
+        t = torch.arange(num_train_timesteps, dtype=torch.float64)
+        if importance_sampling:
+            prob_dist = importance_sampling_fn(t, num_train_timesteps, alpha)
+        else:
+            prob_dist = torch.ones_like(t)
+        # normalize so that sum of prob is 1
+        prob_dist = prob_dist / prob_dist.sum()
+        self.prob_dist = prob_dist.float().to(device)
+        self.cdf = prob_dist.cumsum(0).float().to(device)
+
+        self.generator = torch.Generator(device=device)
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+
+    def __call__(self, batch_size):
+        if self.mode == "multinomial":
+            return torch.multinomial(
+                self.prob_dist,
+                batch_size,
+                replacement=True,
+                generator=self.generator)
+
+        if self.mode == "stratified":
+            # one uniform per equal-width stratum of [0, 1)
+            u = torch.rand(
+                batch_size, device=self.device, generator=self.generator)
+            u = (torch.arange(batch_size, device=self.device) + u) / batch_size
+        else:
+            # antithetic pairs u, 1 - u
+            u = torch.rand((batch_size + 1) // 2,
+                           device=self.device,
+                           generator=self.generator)
+            u = torch.cat([u, 1 - u])[:batch_size]
+        timesteps = torch.searchsorted(self.cdf, u, right=True)
+        return timesteps.clamp(max=self.num_train_timesteps - 1)
+
+
+def text_encoder_forward(text_model, input_ids, start=0, past=None):
+    """Final hidden states of the CLIP `text_model` at the positions `start:` of a sequence.
+
+    `input_ids` are the tokens at these positions, and `past` the key and value states of
+    every layer at the positions `:start`. Also returns the key and value states of every
+    layer at the positions `start:`. Matches `text_model(input_ids)` when `start` is 0.
+    """
+    length = input_ids.shape[1]
+    position_ids = torch.arange(
+        start, start + length, device=input_ids.device).unsqueeze(0)
+    hidden_states = text_model.embeddings(
+        input_ids=input_ids, position_ids=position_ids)
+    # causal mask of the queries `start:` over the keys `:start + length`
+    mask = torch.full((length, start + length),
+                      float("-inf"),
+                      device=input_ids.device).triu(start + 1)
+
+    key_values = []
+    for i, layer in enumerate(text_model.encoder.layers):
+        attention = layer.self_attn
+        residual = hidden_states
+        hidden_states = layer.layer_norm1(hidden_states)
+        key = attention.k_proj(hidden_states)
+        value = attention.v_proj(hidden_states)
+        key_values.append((key, value))
+        if past is not None:
+            key = torch.cat([past[i][0], key], 1)
+            value = torch.cat([past[i][1], value], 1)
+        query = attention.q_proj(hidden_states) * attention.scale
+
+        def heads(states):
+            return states.view(states.shape[0], states.shape[1],
+                               attention.num_heads,
+                               attention.head_dim).transpose(1, 2)
+
+        weights = (heads(query) @ heads(key).transpose(-1, -2)).float() + mask
+        weights = weights.softmax(-1).to(value.dtype)
+        hidden_states = (weights @ heads(value)).transpose(1, 2).reshape(
+            residual.shape)
+        hidden_states = residual + attention.out_proj(hidden_states)
+        hidden_states = hidden_states + layer.mlp(
+            layer.layer_norm2(hidden_states))
+
+    return text_model.final_layer_norm(hidden_states), key_values
+
+
+class TextPrefixCache:
+    """Text encoder states of the template tokens before the first learned token.
+
+    The CLIP text model attends causally, so the states of these positions do not depend on
+    the learned embeddings. They are computed once for every template, and each step only
+    runs the text encoder from the prefix length of each template on, in one pass for every
+    prefix length in the batch.
+    """
+
+    def __init__(self, text_model, template_ids, learned_token_ids,
+                 batch_size=64):
+        if (getattr(text_model.config, "dropout", 0.0) > 0
+                or text_model.config.attention_dropout > 0):
+            raise ValueError(
+                "Caching text encoder prefixes requires a text encoder without dropout."
+            )
+        self.text_model = text_model
+        learned = torch.isin(template_ids,
+                             torch.tensor(learned_token_ids,
+                                          device=template_ids.device))
+        self.prefix_lengths = torch.where(
+            learned.any(1),
+            learned.int().argmax(1), template_ids.shape[1])
+        max_prefix_length = int(self.prefix_lengths.max())
+
+        with torch.no_grad(), torch.autocast(
+                template_ids.device.type, enabled=False):
+            # `text_encoder_forward` runs the layers of the text model itself
+            expected = text_model(template_ids[:batch_size])[0]
+            states, _ = text_encoder_forward(text_model,
+                                             template_ids[:batch_size])
+        if not torch.allclose(states, expected, atol=1e-3):
+            raise ValueError(
+                "`cache_text_prefix` does not support the text encoder of this transformers version."
+            )
 
+        hidden_states, key_values = [], []
+        with torch.no_grad():
+            for start in range(0, len(template_ids), batch_size):
+                states, layer_key_values = text_encoder_forward(
+                    text_model, template_ids[start:start + batch_size])
+                hidden_states.append(states[:, :max_prefix_length])
+                key_values.append([(key[:, :max_prefix_length],
+                                    value[:, :max_prefix_length])
+                                   for key, value in layer_key_values])
+        self.hidden_states = torch.cat(hidden_states)
+        self.key_values = [
+            tuple(torch.cat(states) for states in zip(*layer))
+            for layer in zip(*key_values)
+        ]
 
-def main():
+    def __call__(self, input_ids, template_index):
+        """Final hidden states of the rows `template_index` of the templates, which are `input_ids`."""
+        prefix_lengths = self.prefix_lengths[template_index]
+        hidden_states, rows = [], []
+        for prefix_length in prefix_lengths.unique().tolist():
+            group = (prefix_lengths == prefix_length).nonzero().squeeze(1)
+            templates = template_index[group]
+            past = [(key[templates, :prefix_length],
+                     value[templates, :prefix_length])
+                    for key, value in self.key_values]
+            states, _ = text_encoder_forward(
+                self.text_model, input_ids[group, prefix_length:],
+                prefix_length, past)
+            hidden_states.append(
+                torch.cat([
+                    self.hidden_states[templates, :prefix_length].to(
+                        states.dtype), states
+                ], 1))
+            rows.append(group)
+        # back in the order of the batch
+        return torch.cat(hidden_states)[torch.cat(rows).argsort()]
+
+
+class PromptEmbeddingCache:
+    """LRU cache of the text encoder hidden states of tokenized prompts.
+
+    Entries are keyed by the token ids of a prompt and a hash of the current rows of the
+    learned tokens it contains, so they are invalidated as soon as training updates them.
+    """
+
+    def __init__(self, text_encoder, learned_token_ids, max_size=128):
+        self.text_encoder = text_encoder
+        self.learned_token_ids = set(learned_token_ids)
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, ids):
+        learned_ids = sorted(self.learned_token_ids.intersection(ids))
+        if not learned_ids:
+            return tuple(ids), None
+        embedding = self.text_encoder.get_input_embeddings()
+        rows = embedding(
+            torch.tensor(learned_ids, device=embedding.weight.device))
+        digest = hashlib.sha1(
+            rows.detach().float().cpu().numpy().tobytes()).hexdigest()
+        return tuple(ids), digest
+
+    @torch.no_grad()
+    def __call__(self, input_ids):
+        """Hidden states of the (batch_size, seq_len) `input_ids`, encoding only the misses."""
+        keys = [self.key(ids) for ids in input_ids.tolist()]
+        # first row of every missing key, repeated prompts of the batch are encoded once
+        misses = {}
+        for i, key in enumerate(keys):
+            if key not in self.entries:
+                misses.setdefault(key, i)
+        self.misses += len(misses)
+        self.hits += len(keys) - len(misses)
+        if misses:
+            hidden_states = self.text_encoder(
+                input_ids[list(misses.values())])[0]
+            for key, states in zip(misses, hidden_states):
+                self.entries[key] = states
+        for key in keys:
+            self.entries.move_to_end(key)
+        embeds = torch.stack([self.entries[key] for key in keys])
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return embeds
+
+
+class ValidationEngine:
+    """Generates validation images with the in-memory models of the run.
+
+    The pipeline is built once around `unet`, `vae` and `text_encoder`, prompts are
+    encoded through a `PromptEmbeddingCache` of the `learned_token_ids` (the unconditional
+    embedding only once), and all images of a pass are sampled in one batched call
+    with one seeded generator per image. With `background=True` a pass runs on a worker
+    thread (and its own CUDA stream), and its images are collected by `poll` or `wait`.
+    """
+
+    def __init__(self,
+                 tokenizer,
+                 text_encoder,
+                 unet,
+                 vae,
+                 noise_scheduler,
+                 device,
+                 learned_token_ids,
+                 num_inference_steps=25,
+                 guidance_scale=7.5,
+                 background=False,
+                 offload_vae=False):
+        self.tokenizer = tokenizer
+        self.text_encoder = text_encoder
+        self.unet = unet
+        self.vae = vae
+        self.device = device
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        # the parts of the vae kept on cpu during training (all of it when the exemplar latents
+        # are cached) are moved to the device for the passes only
+        self.offload_vae = offload_vae
+        self.offloaded = []
+        from diffusers import (DPMSolverMultistepScheduler,
+                               StableDiffusionPipeline)
+        self.pipeline = StableDiffusionPipeline(
+            vae=vae,
+            text_encoder=text_encoder,
+            tokenizer=tokenizer,
+            unet=unet,
+            scheduler=DPMSolverMultistepScheduler.from_config(
+                noise_scheduler.config),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+        )
+        self.pipeline.set_progress_bar_config(disable=True)
+        self.embedding_cache = PromptEmbeddingCache(text_encoder,
+                                                    learned_token_ids)
+        self.uncond_embeds = None
+
+        self.executor = None
+        self.stream = None
+        self.pending = None
+        if background:
+            self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1)
+            if device.type == "cuda":
+                self.stream = torch.cuda.Stream(device=device)
+
+    def encode(self, prompt):
+        """Hidden states of `prompt`, a string or a list of strings."""
+        input_ids = self.tokenizer(
+            prompt,
+            padding="max_length",
+            max_length=self.tokenizer.model_max_length,
+            truncation=True,
+            return_tensors="pt").input_ids.to(self.device)
+        return self.embedding_cache(input_ids)
+
+    def unconditional_embeds(self):
+        if self.uncond_embeds is None:
+            # no placeholder token in the empty prompt, so it never changes during training
+            self.uncond_embeds = self.encode("")
+        return self.uncond_embeds
+
+    def generate(self, prompt_embeds, seeds, output_type="pil"):
+        """Sample one image per row of `prompt_embeds`, seeding image i with `seeds[i]`."""
+        generator = None
+        if seeds is not None:
+            generator = [
+                torch.Generator(device=self.device).manual_seed(seed)
+                for seed in seeds
+            ]
+        # the text encoder keeps fp32 weights while the unet and vae may be cast down
+        if self.device.type == "cuda":
+            autocast = torch.autocast("cuda")
+        else:
+            autocast = torch.autocast(
+                "cpu",
+                dtype=torch.bfloat16,
+                enabled=self.unet.dtype == torch.bfloat16)
+        with autocast:
+            return self.pipeline(
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=self.unconditional_embeds().expand_as(
+                    prompt_embeds),
+                num_inference_steps=self.num_inference_steps,
+                guidance_scale=self.guidance_scale,
+                generator=generator,
+                output_type=output_type).images
+
+    def _run(self, prompt_embeds, seeds):
+        if self.stream is None:
+            return self.generate(prompt_embeds, seeds)
+        with torch.cuda.stream(self.stream):
+            return self.generate(prompt_embeds, seeds)
+
+    def submit(self, prompt, num_images, seed, step):
+        """Start a validation pass of `num_images` images of `prompt`, logged at `step`."""
+        # encoded here rather than on the worker thread, which must not use the text encoder
+        self.unconditional_embeds()
+        if self.offload_vae:
+            self.offloaded = [
+                module for module in self.vae.children()
+                if next(module.parameters()).device.type != self.device.type
+            ]
+            for module in self.offloaded:
+                module.to(self.device)
+        # the prompt is encoded right away, as training keeps updating the learned rows
+        prompt_embeds = self.encode(prompt).expand(num_images, -1, -1)
+        seeds = None if seed is None else [
+            seed + i for i in range(num_images)
+        ]
+        if self.executor is None:
+            self.pending = (step, self._run(prompt_embeds, seeds))
+        else:
+            if self.stream is not None:
+                self.stream.wait_stream(torch.cuda.current_stream(self.device))
+            self.pending = (step,
+                            self.executor.submit(self._run, prompt_embeds,
+                                                 seeds))
+
+    def _collect(self):
+        step, images = self.pending
+        self.pending = None
+        if isinstance(images, concurrent.futures.Future):
+            images = images.result()
+        if self.offloaded:
+            for module in self.offloaded:
+                module.to("cpu")
+            self.offloaded = []
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        return step, images
+
+    def poll(self):
+        """Return `(step, images)` of the pass started last if it has finished, else None."""
+        if self.pending is None:
+            return None
+        images = self.pending[1]
+        if isinstance(images, concurrent.futures.Future) and not images.done():
+            return None
+        return self._collect()
+
+    def wait_pending(self):
+        """Block until the pending pass, if any, has finished and return its results."""
+        if self.pending is None:
+            return None
+        return self._collect()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+def log_validation(accelerator, images, prompt, step):
+    for tracker in accelerator.trackers:
+        if tracker.name == "tensorboard":
+            np_images = np.stack([np.asarray(img) for img in images])
+            tracker.writer.add_images(
+                "validation", np_images, step, dataformats="NHWC")
+        if tracker.name == "wandb":
+            import wandb
+            tracker.log({
+                "validation": [
+                    wandb.Image(image, caption=f"{i}: {prompt}")
+                    for i, image in enumerate(images)
+                ]
+            })
+
+
+def run_validation(accelerator, validation_engine, args, step):
+    """Start a validation pass of `args.validation_prompt` and log the finished passes."""
+    logger.info(
+        f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
+        f" {args.validation_prompt}.")
+    finished = validation_engine.wait_pending()
+    if finished is not None:
+        log_validation(accelerator, finished[1], args.validation_prompt,
+                       finished[0])
+    validation_engine.submit(args.validation_prompt,
+                             args.num_validation_images, args.seed, step)
+    if not args.validation_in_background:
+        step, images = validation_engine.wait_pending()
+        log_validation(accelerator, images, args.validation_prompt, step)
+
+
+class StageTimer:
+    """Time of the named stages of each training step.
+
+    On GPU, stages are timed with CUDA events recorded on the current stream, and the
+    events are only read back when `steps` or `summary` is requested, so timing does not
+    stall the step. On CPU, where kernels run synchronously, the wall-clock time is used.
+    While `profiling` is set, stages are also annotated in the `torch.profiler` trace.
+    With `track_memory`, the peak memory allocated on GPU during each stage is recorded.
+    """
+
+    def __init__(self, device, enabled=True, track_memory=False):
+        self.device = device
+        self.enabled = enabled
+        # resets the peak statistics of the allocator at the start of every stage
+        self.track_memory = track_memory and device.type == "cuda"
+        self.memory_peaks = {}
+        self.profiling = False
+        self.use_events = device.type == "cuda"
+        self.current = []
+        self.step_start = None
+        # finished steps whose events may not have completed yet
+        self.unresolved = []
+        # per finished step, the seconds spent in each stage and in the whole step
+        self._steps = []
+        self.summarized = 0
+
+    def clock(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def elapsed(self, start, end):
+        if self.use_events:
+            end.synchronize()
+            return start.elapsed_time(end) / 1000
+        return end - start
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        with (torch.profiler.record_function(name)
+              if self.profiling else contextlib.nullcontext()):
+            if self.track_memory:
+                torch.cuda.reset_peak_memory_stats(self.device)
+            if self.enabled:
+                start = self.clock()
+            yield
+            if self.enabled:
+                self.current.append((name, start, self.clock()))
+            if self.track_memory:
+                # allocator statistics are kept on the host, reading them does not synchronize
+                self.memory_peaks[name] = max(
+                    self.memory_peaks.get(name, 0),
+                    torch.cuda.max_memory_allocated(self.device))
+
+    def record(self, name, seconds):
+        """Add `seconds` measured on the host to stage `name` of the current step."""
+        if self.enabled:
+            self.current.append((name, 0.0, seconds))
+
+    def start_step(self):
+        if self.enabled:
+            self.step_start = self.clock()
+
+    def end_step(self):
+        if self.enabled:
+            self.unresolved.append((self.step_start, self.clock(),
+                                    self.current))
+            self.current = []
+
+    @property
+    def steps(self):
+        for step_start, step_end, stages in self.unresolved:
+            times = collections.defaultdict(float)
+            for name, start, end in stages:
+                times[name] += (end - start if isinstance(end, float) else
+                                self.elapsed(start, end))
+            times["step"] = self.elapsed(step_start, step_end)
+            self._steps.append(dict(times))
+        self.unresolved = []
+        return self._steps
+
+    def summary(self):
+        """Mean milliseconds, and peak memory, of each stage since the last summary."""
+        logs = {
+            f"memory/{name}_peak_mb": peak / 2**20
+            for name, peak in sorted(self.memory_peaks.items())
+        }
+        self.memory_peaks = {}
+        steps = self.steps[self.summarized:]
+        self.summarized = len(self._steps)
+        names = sorted({name for step in steps for name in step})
+        logs.update({
+            f"time/{name}_ms":
+            1000 * sum(step.get(name, 0.0) for step in steps) / len(steps)
+            for name in names
+        })
+        return logs
+
+
+def start_profiler(device):
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    profiler = torch.profiler.profile(activities=activities)
+    profiler.start()
+    return profiler
+
+
+def stop_profiler(profiler, args):
+    """Stop `profiler` and write its trace to `output_dir/profile`."""
+    profiler.stop()
+    trace_dir = os.path.join(args.output_dir, "profile")
+    os.makedirs(trace_dir, exist_ok=True)
+    trace_path = os.path.join(
+        trace_dir,
+        f"trace-steps-{args.profile_start_step}-{args.profile_stop_step}.json")
+    profiler.export_chrome_trace(trace_path)
+    logger.info(f"Saved profiler trace to {trace_path}")
+
+
+class MetricAccumulator:
+    """Running sums of scalar metric tensors, kept on their device.
+
+    Adding a metric does not synchronize with the device, `flush` reads all the means
+    back at once.
+    """
+
+    def __init__(self):
+        self.sums = {}
+        self.counts = collections.Counter()
+
+    def add(self, **metrics):
+        for name, value in metrics.items():
+            if not torch.is_tensor(value):
+                continue
+            value = value.detach().float()
+            self.sums[name] = self.sums[name] + value if name in self.sums else value
+            self.counts[name] += 1
+
+    def flush(self, reduce=None):
+        """Means of the metrics since the last flush.
+
+        `reduce`, e.g. a mean over processes, is applied to the stacked sums before they are
+        read back, so that all processes log the same values. It must then be called by
+        every process, after the same metrics were added.
+        """
+        names = list(self.sums)
+        if not names:
+            return {}
+        sums = torch.stack([self.sums[name] for name in names])
+        if reduce is not None:
+            sums = reduce(sums)
+        sums = sums.tolist()
+        means = {
+            name: total / self.counts[name]
+            for name, total in zip(names, sums)
+        }
+        self.sums = {}
+        self.counts.clear()
+        return means
+
+
+# `--pretrained_model_name_or_path` of the built-in tiny model
+TINY_MODEL_NAME = "tiny"
+# words of the tiny model vocabulary, any other text is tokenized byte by byte
+TINY_MODEL_WORDS = ("a", "the", "and", "on", "in", "cat", "dog", "chair",
+                    "table", "pot", "stool", "box")
+
+
+def create_tiny_model(path):
+    """Write a randomly initialized, tiny Stable Diffusion model to `path`.
+
+    Its tokenizer is byte-level with a few whole words, and its vae downsamples by 2
+    only, so that `--resolution 128` gives the 64x64 latents the discriminator expects.
+    Used for fast CPU smoke tests and benchmarks, nothing needs to be downloaded.
+    """
+    import diffusers
+    from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+    from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+
+    tokenizer_dir = os.path.join(path, "tokenizer")
+    os.makedirs(tokenizer_dir, exist_ok=True)
+    # printable byte-to-unicode table of the CLIP byte-level BPE
+    byte_values = (list(range(ord("!"),
+                              ord("~") + 1)) + list(range(ord("¡"),
+                                                          ord("¬") + 1)) +
+                   list(range(ord("®"),
+                              ord("ÿ") + 1)))
+    chars = [chr(b) for b in byte_values] + [
+        chr(256 + n) for n in range(256 - len(byte_values))
+    ]
+    vocab = chars + [char + "</w>" for char in chars]
+    merges = []
+    for word in TINY_MODEL_WORDS:
+        pieces = list(word[:-1]) + [word[-1] + "</w>"]
+        while len(pieces) > 1:
+            merges.append(f"{pieces[0]} {pieces[1]}")
+            vocab.append(pieces[0] + pieces[1])
+            pieces = [pieces[0] + pieces[1]] + pieces[2:]
+    vocab += ["<|startoftext|>", "<|endoftext|>"]
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+        json.dump({token: i
+                   for i, token in enumerate(dict.fromkeys(vocab))}, f)
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n" + "\n".join(dict.fromkeys(merges)) + "\n")
+    tokenizer = CLIPTokenizer(
+        os.path.join(tokenizer_dir, "vocab.json"),
+        os.path.join(tokenizer_dir, "merges.txt"),
+        model_max_length=77)
+    tokenizer.save_pretrained(tokenizer_dir)
+
+    CLIPTextModel(
+        CLIPTextConfig(
+            vocab_size=len(tokenizer),
+            hidden_size=32,
+            intermediate_size=37,
+            num_hidden_layers=2,
+            num_attention_heads=4,
+            max_position_embeddings=77,
+            projection_dim=32,
+            bos_token_id=tokenizer.bos_token_id,
+            eos_token_id=tokenizer.eos_token_id,
+            pad_token_id=tokenizer.pad_token_id)).save_pretrained(
+                os.path.join(path, "text_encoder"))
+    AutoencoderKL(
+        block_out_channels=(32, 64),
+        down_block_types=("DownEncoderBlock2D", ) * 2,
+        up_block_types=("UpDecoderBlock2D", ) * 2,
+        latent_channels=4,
+        norm_num_groups=32,
+        sample_size=128).save_pretrained(os.path.join(path, "vae"))
+    UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        sample_size=64,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=32,
+        norm_num_groups=32,
+        attention_head_dim=4).save_pretrained(os.path.join(path, "unet"))
+    DDPMScheduler(
+        num_train_timesteps=1000,
+        beta_schedule="scaled_linear",
+        beta_start=0.00085,
+        beta_end=0.012).save_pretrained(os.path.join(path, "scheduler"))
+    # written last, so that its presence means the model is complete
+    with open(os.path.join(path, "model_index.json"), "w") as f:
+        json.dump(
+            {
+                "_class_name": "StableDiffusionPipeline",
+                "_diffusers_version": diffusers.__version__,
+                "scheduler": ["diffusers", "DDPMScheduler"],
+                "text_encoder": ["transformers", "CLIPTextModel"],
+                "tokenizer": ["transformers", "CLIPTokenizer"],
+                "unet": ["diffusers", "UNet2DConditionModel"],
+                "vae": ["diffusers", "AutoencoderKL"],
+                "safety_checker": [None, None],
+                "feature_extractor": [None, None],
+                "requires_safety_checker": False,
+            }, f)
+
+
+def tiny_model_path():
+    """Local copy of the tiny model, created on first use.
+
+    It is written into a temporary folder renamed once complete, so that concurrent runs
+    never load a partially written model.
+    """
+    path = os.path.join(
+        os.path.expanduser("~"), ".cache", "reversion", TINY_MODEL_NAME)
+    if not os.path.exists(os.path.join(path, "model_index.json")):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = tempfile.mkdtemp(dir=os.path.dirname(path))
+        # mkdtemp creates it private to the user
+        os.chmod(tmp_path, 0o755)
+        create_tiny_model(tmp_path)
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # written by a concurrent run in the meantime
+            shutil.rmtree(tmp_path)
+    return path
+
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def load_safetensors_mmap(path):
+    """State dict of the safetensors file at `path`, as views of a copy-on-write memory map.
+
+    Pages are only read when a tensor is used, and processes mapping the same file share
+    them in the page cache until they write to them.
+    """
+    with open(path, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    data = torch.frombuffer(buffer, dtype=torch.uint8)
+    data_start = 8 + header_size
+
+    state_dict = {}
+    for name, info in header.items():
+        if name == "__metadata__":
+            continue
+        begin, end = info["data_offsets"]
+        tensor = data[data_start + begin:data_start + end]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        if tensor.storage_offset() % torch.empty(
+                0, dtype=dtype).element_size():
+            # views need an offset aligned to the element size
+            tensor = tensor.clone()
+        state_dict[name] = tensor.view(dtype).view(info["shape"])
+    return state_dict
+
+
+def weight_cache_key(args, subfolder, dtype):
+    """Key of a pre-cast copy: model, revision, subfolder and dtype, and a stamp of the weights.
+
+    The stamp is the mtime of local weights, or the commit a hub revision resolves to.
+    """
+    source = args.pretrained_model_name_or_path
+    if os.path.isdir(os.path.join(source, subfolder)):
+        source = os.path.abspath(source)
+        stamp = max(
+            os.stat(os.path.join(source, subfolder, name)).st_mtime_ns
+            for name in os.listdir(os.path.join(source, subfolder)))
+    else:
+        from huggingface_hub import hf_hub_download
+
+        # resolved into the snapshots/<commit>/<subfolder>/config.json of the hub cache
+        config_path = hf_hub_download(
+            source, "config.json", subfolder=subfolder, revision=args.revision)
+        stamp = Path(config_path).parts[-3]
+    hasher = hashlib.sha256(
+        f"{source}|{args.revision}|{subfolder}|{dtype}|{stamp}".encode())
+    return f"{subfolder}-{str(dtype).split('.')[-1]}-{hasher.hexdigest()[:16]}"
+
+
+def load_cached_model(model_class, args, subfolder, dtype):
+    """Load a frozen model in `dtype`, memory-mapped from its copy in `args.weight_cache_dir`.
+
+    The copy is written on first use, into a temporary folder renamed once complete, so
+    that concurrent runs never read a partial copy.
+    """
+    from accelerate import init_empty_weights
+
+    cache_dir = os.path.join(args.weight_cache_dir,
+                             weight_cache_key(args, subfolder, dtype))
+    if not os.path.exists(cache_dir):
+        os.makedirs(args.weight_cache_dir, exist_ok=True)
+        model = model_class.from_pretrained(
+            args.pretrained_model_name_or_path,
+            subfolder=subfolder,
+            revision=args.revision,
+            torch_dtype=dtype)
+        tmp_dir = tempfile.mkdtemp(dir=args.weight_cache_dir)
+        # readable by the runs of other users of the host, mkdtemp makes it private
+        os.chmod(tmp_dir, 0o755)
+        model.save_pretrained(tmp_dir, safe_serialization=True)
+        del model
+        try:
+            os.rename(tmp_dir, cache_dir)
+        except OSError:
+            # written by a concurrent run in the meantime
+            shutil.rmtree(tmp_dir)
+
+    state_dict = load_safetensors_mmap(
+        os.path.join(cache_dir, "diffusion_pytorch_model.safetensors"))
+    if version.parse(version.parse(
+            torch.__version__).base_version) >= version.parse("2.1"):
+        # parameters are created on the meta device and replaced by the mapped tensors
+        with init_empty_weights():
+            model = model_class.from_config(model_class.load_config(cache_dir))
+        model.load_state_dict(state_dict, assign=True)
+    else:
+        # `assign` needs torch 2.1, the mapped tensors are copied into the model instead
+        model = model_class.from_config(model_class.load_config(cache_dir))
+        model.to(dtype)
+        model.load_state_dict(state_dict)
+    model.eval()
+    return model
+
+
+def load_models(args):
+    """Load the tokenizer, the noise scheduler and the pretrained text encoder, vae and unet.
+
+    With `args.weight_cache_dir`, the vae and unet are memory-mapped in the dtype of
+    `args.mixed_precision`.
+    """
+    from diffusers import AutoencoderKL, DDPMScheduler, UNet2DConditionModel
+    from transformers import CLIPTextModel, CLIPTokenizer
+
+    if args.pretrained_model_name_or_path == TINY_MODEL_NAME:
+        args.pretrained_model_name_or_path = tiny_model_path()
+    # Load tokenizer
+    if args.tokenizer_name:
+        tokenizer = CLIPTokenizer.from_pretrained(args.tokenizer_name)
+    elif args.pretrained_model_name_or_path:
+        tokenizer = CLIPTokenizer.from_pretrained(
+            args.pretrained_model_name_or_path, subfolder="tokenizer")
+
+    # Load scheduler and models
+    noise_scheduler = DDPMScheduler.from_pretrained(
+        args.pretrained_model_name_or_path, subfolder="scheduler")
+    text_encoder = CLIPTextModel.from_pretrained(
+        args.pretrained_model_name_or_path,
+        subfolder="text_encoder",
+        revision=args.revision)
+    if args.weight_cache_dir is not None:
+        weight_dtype = {
+            "fp16": torch.float16,
+            "bf16": torch.bfloat16
+        }.get(args.mixed_precision, torch.float32)
+        vae = load_cached_model(AutoencoderKL, args, "vae", weight_dtype)
+        unet = load_cached_model(UNet2DConditionModel, args, "unet",
+                                 weight_dtype)
+    else:
+        vae = AutoencoderKL.from_pretrained(
+            args.pretrained_model_name_or_path,
+            subfolder="vae",
+            revision=args.revision)
+        unet = UNet2DConditionModel.from_pretrained(
+            args.pretrained_model_name_or_path,
+            subfolder="unet",
+            revision=args.revision)
+
+    return tokenizer, noise_scheduler, text_encoder, vae, unet
+
+
+def add_placeholder_tokens(tokenizer, text_encoder, args):
+    """Add the placeholder tokens to the tokenizer and text encoder.
+
+    Returns the ids of the placeholder tokens and of their initializer tokens.
+    """
+    # Add the placeholder tokens in tokenizer
+    initializer_token_ids = []
+    placeholder_token_ids = []
+    for placeholder_token, initializer_token in zip(args.placeholder_token,
+                                                    args.initializer_token):
+        num_added_tokens = tokenizer.add_tokens(placeholder_token)
+        if num_added_tokens == 0:
+            raise ValueError(
+                f"The tokenizer already contains the token {placeholder_token}. Please pass a different"
+                " `placeholder_token` that is not already in the tokenizer.")
+
+        # Convert the initializer_token, placeholder_token to ids
+        token_ids = tokenizer.encode(
+            initializer_token, add_special_tokens=False)
+        # Check if initializer_token is a single token or a sequence of tokens
+        if len(token_ids) > 1:
+            raise ValueError("The initializer token must be a single token.")
+
+        initializer_token_ids.append(token_ids[0])
+        placeholder_token_ids.append(
+            tokenizer.convert_tokens_to_ids(placeholder_token))
+
+    # Resize the token embeddings as we are adding new special tokens to the tokenizer
+    text_encoder.resize_token_embeddings(len(tokenizer))
+
+    return placeholder_token_ids, initializer_token_ids
+
+
+def train(args,
+          models,
+          placeholder_token_ids,
+          initializer_token_ids,
+          stage_timer=None,
+          persistent_workers=True):
+    """Learn the placeholder token embeddings with the models returned by `load_models`.
+
+    The models can be reused for several calls: the placeholder rows are re-initialized
+    at the start of every call and only they are modified by training. A `StageTimer`
+    passed as `stage_timer` records where the time of each step goes. Callers running
+    many trainings in one process pass `persistent_workers=False`, so that the dataloader
+    workers of `--dataloader_throughput_mode` do not outlive the call.
+    """
+    import diffusers
+    import transformers
+    from accelerate import Accelerator
+    from accelerate.utils import set_seed
+    from diffusers.optimization import get_scheduler
+
+    tokenizer, noise_scheduler, text_encoder, vae, unet = models
 
-    args = parse_args()
-    print(f'args.learning_rate={args.learning_rate}')
     logging_dir = os.path.join(args.output_dir, args.logging_dir)
 
     accelerator = Accelerator(
@@ -634,6 +2580,7 @@ def main():
     )
 
     if args.report_to == "wandb":
+        from diffusers.utils import is_wandb_available
         if not is_wandb_available():
             raise ImportError(
                 "Make sure to install wandb if you want to use it for logging during training."
@@ -647,6 +2594,7 @@ def main():
         level=logging.INFO,
     )
     logger.info(accelerator.state, main_process_only=False)
+    logger.info(f"Learning rate: {args.learning_rate}")
     if accelerator.is_local_main_process:
         transformers.utils.logging.set_verbosity_warning()
         diffusers.utils.logging.set_verbosity_info()
@@ -654,9 +2602,10 @@ def main():
         transformers.utils.logging.set_verbosity_error()
         diffusers.utils.logging.set_verbosity_error()
 
-    # If passed along, set the training seed now.
+    # If passed along, set the training seed now. Each process draws its own noise, the
+    # modules initialized randomly on each process are synchronized after creation.
     if args.seed is not None:
-        set_seed(args.seed)
+        set_seed(args.seed, device_specific=True)
 
     # Handle the repository creation
     if accelerator.is_main_process:
@@ -666,6 +2615,7 @@ def main():
                     Path(args.output_dir).name, token=args.hub_token)
             else:
                 repo_name = args.hub_model_id
+            from huggingface_hub import Repository, create_repo
             create_repo(repo_name, exist_ok=True, token=args.hub_token)
             repo = Repository(
                 args.output_dir, clone_from=repo_name, token=args.hub_token)
@@ -679,46 +2629,23 @@ def main():
         elif args.output_dir is not None:
             os.makedirs(args.output_dir, exist_ok=True)
 
-    # Load tokenizer
-    if args.tokenizer_name:
-        tokenizer = CLIPTokenizer.from_pretrained(args.tokenizer_name)
-    elif args.pretrained_model_name_or_path:
-        tokenizer = CLIPTokenizer.from_pretrained(
-            args.pretrained_model_name_or_path, subfolder="tokenizer")
-
-    # Load scheduler and models
-    noise_scheduler = DDPMScheduler.from_pretrained(
-        args.pretrained_model_name_or_path, subfolder="scheduler")
-    text_encoder = CLIPTextModel.from_pretrained(
-        args.pretrained_model_name_or_path,
-        subfolder="text_encoder",
-        revision=args.revision)
-    vae = AutoencoderKL.from_pretrained(
-        args.pretrained_model_name_or_path,
-        subfolder="vae",
-        revision=args.revision)
-    unet = UNet2DConditionModel.from_pretrained(
-        args.pretrained_model_name_or_path,
-        subfolder="unet",
-        revision=args.revision)
-
-    # Add the placeholder token in tokenizer
-    num_added_tokens = tokenizer.add_tokens(args.placeholder_token)
-    if num_added_tokens == 0:
-        raise ValueError(
-            f"The tokenizer already contains the token {args.placeholder_token}. Please pass a different"
-            " `placeholder_token` that is not already in the tokenizer.")
-
-    # Convert the initializer_token, placeholder_token to ids
-    token_ids = tokenizer.encode(
-        args.initializer_token, add_special_tokens=False)
-    # Check if initializer_token is a single token or a sequence of tokens
-    if len(token_ids) > 1:
-        raise ValueError("The initializer token must be a single token.")
+    # With several relations, each one writes its learned embeddings to its own sub folder
+    if len(args.train_data_dir) == 1:
+        relation_output_dirs = [args.output_dir]
+    else:
+        relation_output_dirs = [
+            os.path.join(args.output_dir,
+                         os.path.basename(os.path.normpath(data_dir)))
+            for data_dir in args.train_data_dir
+        ]
+        if accelerator.is_main_process:
+            for relation_output_dir in relation_output_dirs:
+                os.makedirs(relation_output_dir, exist_ok=True)
 
-    initializer_token_id = token_ids[0]
-    placeholder_token_id = tokenizer.convert_tokens_to_ids(
-        args.placeholder_token)
+    # the arguments of the run, read back by results_index.py
+    if accelerator.is_main_process:
+        with open(os.path.join(args.output_dir, "args.json"), "w") as f:
+            json.dump(vars(args), f, indent=2)
 
     # stop words id
     expanded_stop_words = stop_words + relation_words  # add relation words to stop_words
@@ -731,12 +2658,21 @@ def main():
     # stop_ids = stop_ids + [tokenizer.bos_token_id, tokenizer.eos_token_id] # add special token ids to stop ids
     special_ids = [tokenizer.bos_token_id, tokenizer.eos_token_id]
 
-    # Resize the token embeddings as we are adding new special tokens to the tokenizer
-    text_encoder.resize_token_embeddings(len(tokenizer))
+    steer_loss_fn = SteerLoss(
+        len(tokenizer),
+        stop_ids,
+        special_ids,
+        placeholder_token_ids,
+        temperature=args.temperature).to(accelerator.device)
 
-    # Initialise the newly added placeholder token with the embeddings of the initializer token
+    # Initialise the newly added placeholder tokens with the embeddings of the initializer tokens
     token_embeds = text_encoder.get_input_embeddings().weight.data
-    token_embeds[placeholder_token_id] = token_embeds[initializer_token_id]
+    token_embeds[placeholder_token_ids] = token_embeds[initializer_token_ids]
+
+    if args.compact_embeddings:
+        text_encoder.set_input_embeddings(
+            TrainableTokenEmbedding(text_encoder.get_input_embeddings(),
+                                    placeholder_token_ids))
 
     # Freeze vae and unet
     vae.requires_grad_(False)
@@ -754,18 +2690,24 @@ def main():
         unet.enable_gradient_checkpointing()
 
     if args.enable_xformers_memory_efficient_attention:
+        from diffusers.utils.import_utils import is_xformers_available
         if is_xformers_available():
             unet.enable_xformers_memory_efficient_attention()
         else:
             raise ValueError(
                 "xformers is not available. Make sure it is installed correctly"
             )
+    if args.attention_slicing:
+        unet.set_attention_slice("auto")
 
     # Enable TF32 for faster training on Ampere GPUs,
     # cf https://pytorch.org/docs/stable/notes/cuda.html#tensorfloat-32-tf32-on-ampere-devices
     if args.allow_tf32:
         torch.backends.cuda.matmul.allow_tf32 = True
 
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
     if args.scale_lr:
         args.learning_rate = (
             args.learning_rate * args.gradient_accumulation_steps *
@@ -773,30 +2715,77 @@ def main():
 
     # Initialize the optimizer
     optimizer = torch.optim.AdamW(
-        text_encoder.get_input_embeddings().parameters(
-        ),  # only optimize the embeddings
+        [
+            p for p in text_encoder.get_input_embeddings().parameters()
+            if p.requires_grad
+        ],  # only optimize the embeddings
         lr=args.learning_rate,
         betas=(args.adam_beta1, args.adam_beta2),
         weight_decay=args.adam_weight_decay,
         eps=args.adam_epsilon,
     )
 
-    # Dataset and DataLoaders creation:
-    train_dataset = ReVersionDataset(
-        data_root=args.train_data_dir,
-        tokenizer=tokenizer,
-        size=args.resolution,
-        placeholder_token=args.placeholder_token,
-        repeats=args.repeats,
-        center_crop=args.center_crop,
-        set="train",
-        relation_words=relation_words,
-        num_positives=args.num_positives)
+    # Dataset and DataLoaders creation, batches mix the exemplars of all relations:
+    relation_datasets = [
+        ReVersionDataset(
+            data_root=data_dir,
+            tokenizer=tokenizer,
+            size=args.resolution,
+            placeholder_token=placeholder_token,
+            repeats=args.repeats,
+            center_crop=args.center_crop,
+            set="train",
+            relation_words=relation_words,
+            num_positives=args.num_positives,
+            shard_path=None
+            if args.train_data_shard is None else args.train_data_shard[r],
+            relation_index=r,
+            buckets=aspect_ratio_buckets(
+                args.resolution, args.bucket_step, args.bucket_max_ratio)
+            if args.aspect_ratio_buckets else None)
+        for r, (data_dir, placeholder_token) in enumerate(
+            zip(args.train_data_dir, args.placeholder_token))
+    ]
+    train_dataset = torch.utils.data.ConcatDataset(relation_datasets)
+    # all processes shuffle the same way, the prepared loader shards the batches between them
+    sampler_seed = [
+        args.seed if args.seed is not None else random.randrange(2**31)
+    ]
+    if accelerator.num_processes > 1:
+        from accelerate.utils import broadcast_object_list
+        broadcast_object_list(sampler_seed)
+    train_sampler = ResumableSampler(train_dataset, seed=sampler_seed[0])
+    loader_kwargs = {}
+    if args.dataloader_throughput_mode:
+        for dataset in relation_datasets:
+            dataset.return_uint8 = True
+        # flipped in `preprocess_pixels` instead
+        flip_p = relation_datasets[0].flip_p
+        # workers keep their state across epochs, and batches are pinned so that the
+        # host to device copies in the training loop can overlap with compute
+        loader_kwargs["pin_memory"] = accelerator.device.type == "cuda"
+        if args.dataloader_num_workers > 0:
+            loader_kwargs["persistent_workers"] = persistent_workers
+            loader_kwargs["prefetch_factor"] = args.dataloader_prefetch_factor
+
+    bucket_sampler = None
+    if args.aspect_ratio_buckets:
+        # batches of exemplars with the same shape
+        bucket_sampler = BucketBatchSampler(train_sampler, [
+            dataset.image_buckets[i % dataset.num_images]
+            for dataset in relation_datasets for i in range(len(dataset))
+        ], args.train_batch_size, accelerator.num_processes)
+        loader_kwargs["batch_sampler"] = bucket_sampler
+    else:
+        loader_kwargs["batch_size"] = args.train_batch_size
+        loader_kwargs["sampler"] = train_sampler
     train_dataloader = torch.utils.data.DataLoader(
         train_dataset,
-        batch_size=args.train_batch_size,
-        shuffle=True,
-        num_workers=args.dataloader_num_workers)
+        num_workers=args.dataloader_num_workers,
+        # seeds the workers from its own generator instead of drawing from the global torch RNG
+        # at every epoch, which would shift the RNG stream of a resumed run
+        generator=torch.Generator().manual_seed(train_sampler.seed),
+        **loader_kwargs)
 
     # Scheduler and math around the number of training steps.
     overrode_max_train_steps = False
@@ -806,20 +2795,27 @@ def main():
         args.max_train_steps = args.num_train_epochs * num_update_steps_per_epoch
         overrode_max_train_steps = True
 
+    # the prepared scheduler steps once per process on each optimization step, and not on
+    # the accumulated micro-steps
     lr_scheduler = get_scheduler(
         args.lr_scheduler,
         optimizer=optimizer,
-        num_warmup_steps=args.lr_warmup_steps *
-        args.gradient_accumulation_steps,
-        num_training_steps=args.max_train_steps *
-        args.gradient_accumulation_steps,
+        num_warmup_steps=args.lr_warmup_steps * accelerator.num_processes,
+        num_training_steps=args.max_train_steps * accelerator.num_processes,
     )
-    print("gan_loss_weight is ", args.gan_loss_weight)
-    print("steer_loss_weight is ", args.steer_loss_weight)
+    logger.info(f"GAN loss weight: {args.gan_loss_weight}")
+    logger.info(f"Steer loss weight: {args.steer_loss_weight}")
 
     # Prepare everything with our `accelerator`.
+    # in throughput mode batches are copied to the device without blocking in the loop
     text_encoder, optimizer, train_dataloader, lr_scheduler = accelerator.prepare(
-        text_encoder, optimizer, train_dataloader, lr_scheduler)
+        text_encoder,
+        optimizer,
+        train_dataloader,
+        lr_scheduler,
+        device_placement=[
+            True, True, not args.dataloader_throughput_mode, True
+        ])
 
     # For mixed precision training we cast the unet and vae weights to half-precision
     # as these models are only used for inference, keeping weights in full precision is not required.
@@ -832,6 +2828,57 @@ def main():
     # Move vae and unet to device and cast to weight_dtype
     unet.to(accelerator.device, dtype=weight_dtype)
     vae.to(accelerator.device, dtype=weight_dtype)
+    if args.channels_last:
+        unet.to(memory_format=torch.channels_last)
+        vae.to(memory_format=torch.channels_last)
+
+    # Encode the exemplars once, then free the vae from the accelerator
+    latent_mean, latent_std = None, None
+    if args.cache_latents:
+        logger.info("Caching exemplar latents")
+        # the other processes then read the latents the main process wrote to the cache dir
+        with accelerator.main_process_first():
+            latent_caches = [
+                build_latent_cache(vae, dataset, args, accelerator.device,
+                                   weight_dtype)
+                for dataset in relation_datasets
+            ]
+        latent_mean = torch.cat([mean for mean, _ in latent_caches])
+        latent_std = torch.cat([std for _, std in latent_caches])
+        # row of the first exemplar of each relation in the concatenated cache
+        latent_offsets = torch.tensor(
+            [0] + [dataset.num_images for dataset in relation_datasets[:-1]],
+            device=accelerator.device).cumsum(0)
+        for dataset in relation_datasets:
+            dataset.return_pixel_values = False
+        vae.to("cpu")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    elif args.low_memory:
+        # training only encodes, validation moves the decoder back for its passes
+        vae.decoder.to("cpu")
+        vae.post_quant_conv.to("cpu")
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    # States of the template tokens before the placeholder tokens, which training never changes
+    text_prefix_cache = None
+    if args.cache_text_prefix:
+        with accelerator.autocast():
+            text_prefix_cache = TextPrefixCache(
+                accelerator.unwrap_model(text_encoder).text_model,
+                torch.cat([
+                    dataset.template_ids for dataset in relation_datasets
+                ]).to(accelerator.device), placeholder_token_ids)
+        logger.info(
+            "Cached the text encoder states of the template tokens before the placeholder tokens,"
+            f" {text_prefix_cache.prefix_lengths.float().mean():.1f} per template on average"
+        )
+        # row of the first template of each relation in the cache
+        template_offsets = torch.tensor(
+            [0] +
+            [len(dataset.template_ids) for dataset in relation_datasets[:-1]],
+            device=accelerator.device).cumsum(0)
 
     # We need to recalculate our total training steps as the size of the training dataloader may have changed.
     num_update_steps_per_epoch = math.ceil(
@@ -845,7 +2892,12 @@ def main():
     # We need to initialize the trackers we use, and also store our configuration.
     # The trackers initializes automatically on the main process.
     if accelerator.is_main_process:
-        accelerator.init_trackers("textual_inversion", config=vars(args))
+        # trackers only accept scalar hyperparameters, so list arguments are joined
+        tracker_config = {
+            key: " ".join(map(str, value)) if isinstance(value, list) else value
+            for key, value in vars(args).items()
+        }
+        accelerator.init_trackers("textual_inversion", config=tracker_config)
 
     # Train!
     total_batch_size = args.train_batch_size * accelerator.num_processes * args.gradient_accumulation_steps
@@ -864,7 +2916,48 @@ def main():
     global_step = 0
     first_epoch = 0
 
+    # Relation-Focal Importance Sampling
+    if args.importance_sampling:
+        logger.info("Using Relation-Focal Importance Sampling")
+    timestep_sampler = TimestepSampler(
+        noise_scheduler.config.num_train_timesteps,
+        accelerator.device,
+        importance_sampling=args.importance_sampling,
+        alpha=args.scaled_cosine_alpha,
+        mode=args.timestep_sampling,
+        seed=None
+        if args.seed is None else args.seed + accelerator.process_index)
+    # one discriminator per relation
+    num_relations = len(relation_datasets)
+    discriminators = [
+        Discriminator(input_channels=4).to(accelerator.device)
+        for _ in range(num_relations)
+    ]
+    # their gradients are averaged over the processes by `average_gradients`, from the same weights
+    if accelerator.num_processes > 1:
+        for discriminator in discriminators:
+            broadcast_module(discriminator)
+    optimizers_D = [
+        torch.optim.Adam(discriminator.parameters(), lr=args.learning_rate, betas=(0.5, 0.999))
+        for discriminator in discriminators
+    ]
+    # the discriminators keep fp32 weights and run under autocast in mixed precision
+    discriminator_autocast = torch.autocast(
+        device_type=accelerator.device.type,
+        dtype=weight_dtype,
+        enabled=weight_dtype != torch.float32)
+    # fp16 discriminator gradients are scaled on the device training runs on
+    if hasattr(torch.amp, "GradScaler"):
+        d_grad_scaler = torch.amp.GradScaler(
+            accelerator.device.type, enabled=weight_dtype == torch.float16)
+    else:
+        # torch < 2.3 only scales gradients on CUDA
+        d_grad_scaler = torch.cuda.amp.GradScaler(
+            enabled=weight_dtype == torch.float16
+            and accelerator.device.type == "cuda")
+
     # Potentially load in the weights and states from a previous save
+    resume_step = 0
     if args.resume_from_checkpoint:
         if args.resume_from_checkpoint != "latest":
             path = os.path.basename(args.resume_from_checkpoint)
@@ -882,7 +2975,16 @@ def main():
             args.resume_from_checkpoint = None
         else:
             accelerator.print(f"Resuming from checkpoint {path}")
-            accelerator.load_state(os.path.join(args.output_dir, path))
+            checkpoint_dir = os.path.join(args.output_dir, path)
+            if os.path.exists(
+                    os.path.join(checkpoint_dir, TRAINING_STATE_NAME)):
+                load_training_state(checkpoint_dir, accelerator, text_encoder,
+                                    placeholder_token_ids, optimizer,
+                                    lr_scheduler, discriminators, optimizers_D,
+                                    d_grad_scaler, timestep_sampler,
+                                    train_sampler)
+            else:
+                accelerator.load_state(checkpoint_dir)
             global_step = int(path.split("-")[1])
 
             resume_global_step = global_step * args.gradient_accumulation_steps
@@ -890,67 +2992,92 @@ def main():
             resume_step = resume_global_step % (
                 num_update_steps_per_epoch * args.gradient_accumulation_steps)
 
+    # built once, reusing the models of the run for every validation pass, on the main process
+    validation_engine = None
+    if args.validation_prompt is not None and accelerator.is_main_process:
+        validation_engine = ValidationEngine(
+            tokenizer,
+            accelerator.unwrap_model(text_encoder),
+            unet,
+            vae,
+            noise_scheduler,
+            accelerator.device,
+            placeholder_token_ids,
+            background=args.validation_in_background,
+            offload_vae=args.cache_latents or args.low_memory)
+
     # Only show the progress bar once on each machine.
     progress_bar = tqdm(
         range(global_step, args.max_train_steps),
         disable=not accelerator.is_local_main_process)
     progress_bar.set_description("Steps")
 
-    # keep original embeddings as reference
-    orig_embeds_params = accelerator.unwrap_model(
-        text_encoder).get_input_embeddings().weight.data.clone()
+    # keep original embeddings as reference (not needed when only the placeholder row is trainable)
+    orig_embeds_params = None
+    if not args.compact_embeddings:
+        orig_embeds_params = accelerator.unwrap_model(
+            text_encoder).get_input_embeddings().weight.data.clone()
+        index_no_updates = ~torch.isin(
+            torch.arange(len(tokenizer)), torch.tensor(placeholder_token_ids))
+
+    if stage_timer is None:
+        stage_timer = StageTimer(
+            accelerator.device,
+            enabled=args.log_stage_times,
+            track_memory=args.log_stage_memory)
+    metrics = MetricAccumulator()
+    profiler = None
+    stage_timer.start_step()
+    data_start = time.perf_counter()
 
-    # Relation-Focal Importance Sampling
-    if args.importance_sampling:
-        print("Using Relation-Focal Importance Sampling")
-        list_of_candidates = [
-            x for x in range(noise_scheduler.config.num_train_timesteps)
-        ]
-        prob_dist = [
-            importance_sampling_fn(x,
-                                   noise_scheduler.config.num_train_timesteps,
-                                   args.scaled_cosine_alpha)
-            for x in list_of_candidates
-        ]
-        prob_sum = 0
-        # normalize the prob_list so that sum of prob is 1
-        for i in prob_dist:
-            prob_sum += i
-        prob_dist = [x / prob_sum for x in prob_dist]
-    discriminator = Discriminator(input_channels=4).to(accelerator.device)
-    optimizer_D = torch.optim.Adam(discriminator.parameters(), lr=args.learning_rate, betas=(0.5, 0.999))
     for epoch in range(first_epoch, args.num_train_epochs):
         text_encoder.train()
+        # Jump straight to the resumed sample instead of iterating over the skipped batches
+        if bucket_sampler is not None:
+            bucket_sampler.set_position(
+                epoch, resume_step *
+                accelerator.num_processes if epoch == first_epoch else 0)
+        else:
+            train_sampler.set_position(
+                epoch, resume_step * args.train_batch_size *
+                accelerator.num_processes if epoch == first_epoch else 0)
         for step, batch in enumerate(train_dataloader):
-            # Skip steps until we reach the resumed step
-            if args.resume_from_checkpoint and epoch == first_epoch and step < resume_step:
-                if step % args.gradient_accumulation_steps == 0:
-                    progress_bar.update(1)
-                continue
-
+            if args.dataloader_throughput_mode:
+                batch = {
+                    key: value.to(accelerator.device, non_blocking=True)
+                    for key, value in batch.items()
+                }
+            stage_timer.record("data", time.perf_counter() - data_start)
             with accelerator.accumulate(text_encoder):
                 # Convert images to latent space
-                latents = vae.encode(batch["pixel_values"].to(
-                    dtype=weight_dtype)).latent_dist.sample().detach()
-                latents = latents * vae.config.scaling_factor
+                with stage_timer("vae_encode"):
+                    if latent_mean is not None:
+                        latent_index = batch["image_index"] + latent_offsets[
+                            batch["relation_index"]]
+                        mean = latent_mean[latent_index]
+                        std = latent_std[latent_index]
+                        latents = (mean + std * torch.randn_like(mean)).to(
+                            dtype=weight_dtype)
+                    else:
+                        if args.dataloader_throughput_mode:
+                            pixel_values = preprocess_pixels(
+                                batch["pixel_values"], flip_p, weight_dtype)
+                        else:
+                            pixel_values = batch["pixel_values"].to(
+                                dtype=weight_dtype)
+                        scale = progressive_scale(global_step, args)
+                        if scale < 1:
+                            pixel_values = downscale_pixels(
+                                pixel_values, scale, args.bucket_step)
+                        latents = vae.encode(
+                            pixel_values).latent_dist.sample().detach()
+                    latents = latents * vae.config.scaling_factor
                 # Sample noise that we'll add to the latents
                 noise = torch.randn_like(latents)
                 bsz = latents.shape[0]
                 # pdb.set_trace()
-                # timestep (t) sampling
-                timesteps = torch.randint(
-                    0,
-                    noise_scheduler.config.num_train_timesteps, (bsz, ),
-                    device=latents.device)
-                # Relation-Focal Importance Sampling
-                if args.importance_sampling:
-                    timesteps = np.random.choice(
-                        list_of_candidates,
-                        size=bsz,
-                        replace=True,
-                        p=prob_dist)
-                    timesteps = torch.tensor(timesteps).cuda()
-                timesteps = timesteps.long()
+                # timestep (t) sampling, with Relation-Focal Importance Sampling if enabled
+                timesteps = timestep_sampler(bsz)
 
                 # Add noise to the latents according to the noise magnitude at each timestep
                 # (this is the forward diffusion process)
@@ -958,26 +3085,61 @@ def main():
                     latents, noise, timesteps)
 
                 # Get the text embedding for conditioning
-                encoder_hidden_states = text_encoder(
-                    batch["input_ids"])[0].to(dtype=weight_dtype)
+                with stage_timer("text_encoder"):
+                    if text_prefix_cache is not None:
+                        with accelerator.autocast():
+                            encoder_hidden_states = text_prefix_cache(
+                                batch["input_ids"], batch["template_index"] +
+                                template_offsets[batch["relation_index"]])
+                    else:
+                        encoder_hidden_states = text_encoder(
+                            batch["input_ids"])[0]
+                    encoder_hidden_states = encoder_hidden_states.to(
+                        dtype=weight_dtype)
 
                 # Predict the noise residual
-                model_pred = unet(noisy_latents, timesteps,
-                                  encoder_hidden_states).sample
-                with torch.no_grad():
-                    generated_samples = model_pred.detach()  # 冻结生成器
-                real_labels = torch.ones(bsz, device=accelerator.device)
-                fake_labels = torch.zeros(bsz, device=accelerator.device)
-                optimizer_D.zero_grad()
-                real_loss = F.binary_cross_entropy(discriminator(latents), real_labels)
-                fake_loss = F.binary_cross_entropy(discriminator(generated_samples), fake_labels)
-                d_loss = (real_loss + fake_loss) / 2
-                accelerator.backward(d_loss)
-                optimizer_D.step()
-
-                # GAN 训练：优化生成器（UNet）
+                with stage_timer("unet"):
+                    model_pred = unet(noisy_latents, timesteps,
+                                      encoder_hidden_states).sample
+                gan_loss = 0.0
+                if args.gan_loss_weight > 0:
+                    with stage_timer("discriminator"):
+                        with torch.no_grad():
+                            generated_samples = model_pred.detach()  # 冻结生成器
+                        # each relation's discriminator only sees the samples of its relation,
+                        # losses are summed over samples so that they average over the whole batch
+                        # once per optimization step, not on every accumulated micro-step
+                        if (accelerator.sync_gradients
+                                and global_step % args.discriminator_update_steps == 0):
+                            d_loss = 0.0
+                            with discriminator_autocast:
+                                for r, selector in relation_selectors(
+                                        batch["relation_index"], num_relations):
+                                    d_loss = d_loss + discriminator_loss(
+                                        discriminators[r], latents[selector],
+                                        generated_samples[selector]) / bsz
+                            for optimizer_D in optimizers_D:
+                                optimizer_D.zero_grad()
+                            d_grad_scaler.scale(d_loss).backward()
+                            if accelerator.num_processes > 1:
+                                average_gradients(
+                                    [d.parameters() for d in discriminators],
+                                    accelerator.num_processes)
+                            for discriminator, optimizer_D in zip(
+                                    discriminators, optimizers_D):
+                                # relations without samples in the batch have no gradients
+                                if next(discriminator.parameters()).grad is not None:
+                                    d_grad_scaler.step(optimizer_D)
+                            d_grad_scaler.update()
+                            metrics.add(discriminator_loss=d_loss)
+
+                        # GAN 训练：优化生成器（UNet）
+                        with discriminator_autocast:
+                            for r, selector in relation_selectors(
+                                    batch["relation_index"], num_relations):
+                                gan_loss = gan_loss + generator_loss(
+                                    discriminators[r], model_pred[selector]) / bsz
                 optimizer.zero_grad()
-                gan_loss = F.binary_cross_entropy(discriminator(model_pred), real_labels)  # 生成器希望生成真实样本
                 denoise_loss = F.mse_loss(model_pred.float(), noise.float(), reduction="mean")
                 loss = args.denoise_loss_weight * denoise_loss + args.gan_loss_weight * gan_loss
                 # Get the target for loss depending on the prediction type
@@ -1002,131 +3164,160 @@ def main():
                 token_embedding = accelerator.unwrap_model(
                     text_encoder).get_input_embeddings()  # with grad
 
-                # # L_steer
+                # # L_steer, every sample is contrasted against the words of its own relation
                 if args.steer_loss_weight > 0:
                     assert args.num_positives > 0
-                    steer_loss = calculate_steer_loss(
-                        token_embedding,
-                        batch["input_ids"],
-                        placeholder_token_id,
-                        stop_ids,
-                        special_ids,
-                        batch["positive_ids"],
-                        temperature=args.temperature)
+                    with stage_timer("steer_loss"):
+                        steer_loss = steer_loss_fn(token_embedding,
+                                                   batch["input_ids"],
+                                                   batch["positive_ids"])
                     weighted_steer_loss = args.steer_loss_weight * steer_loss
                     loss += weighted_steer_loss
 
-                accelerator.backward(loss)
-
-                optimizer.step()
-                lr_scheduler.step()
-                optimizer.zero_grad()
+                with stage_timer("backward"):
+                    accelerator.backward(loss)
+                    # the cached prefix path runs the text encoder outside of DDP
+                    if (text_prefix_cache is not None
+                            and accelerator.num_processes > 1
+                            and accelerator.sync_gradients):
+                        average_gradients([[
+                            p for p in token_embedding.parameters()
+                            if p.requires_grad
+                        ]], accelerator.num_processes)
+
+                with stage_timer("optimizer"):
+                    optimizer.step()
+                    lr_scheduler.step()
+                    optimizer.zero_grad()
 
                 # Let's make sure we don't update any embedding weights besides the newly added token
-                index_no_updates = torch.arange(
-                    len(tokenizer)) != placeholder_token_id
-                with torch.no_grad():
-                    accelerator.unwrap_model(
-                        text_encoder).get_input_embeddings(
-                        ).weight[index_no_updates] = orig_embeds_params[
-                            index_no_updates]
+                if orig_embeds_params is not None:
+                    with stage_timer("embedding_restore"), torch.no_grad():
+                        accelerator.unwrap_model(
+                            text_encoder).get_input_embeddings(
+                            ).weight[index_no_updates] = orig_embeds_params[
+                                index_no_updates]
 
             # Checks if the accelerator has performed an optimization step behind the scenes
             if accelerator.sync_gradients:
+                stage_timer.end_step()
                 progress_bar.update(1)
                 global_step += 1
-                if global_step % args.save_steps == 0:
-                    save_path = os.path.join(
-                        args.output_dir,
-                        f"learned_embeds-steps-{global_step}.bin")
-                    save_progress(text_encoder, placeholder_token_id,
-                                  accelerator, args, save_path)
+                if global_step == args.profile_start_step:
+                    profiler = start_profiler(accelerator.device)
+                    stage_timer.profiling = True
+                if global_step == args.profile_stop_step and profiler is not None:
+                    stop_profiler(profiler, args)
+                    profiler = None
+                    stage_timer.profiling = False
+                if (global_step % args.save_steps == 0
+                        and accelerator.is_main_process):
+                    for placeholder_token_id, placeholder_token, relation_output_dir in zip(
+                            placeholder_token_ids, args.placeholder_token,
+                            relation_output_dirs):
+                        save_path = os.path.join(
+                            relation_output_dir,
+                            f"learned_embeds-steps-{global_step}.bin")
+                        save_progress(text_encoder, placeholder_token_id,
+                                      placeholder_token, accelerator,
+                                      save_path)
 
                 if global_step % args.checkpointing_steps == 0:
-                    if accelerator.is_main_process:
-                        save_path = os.path.join(args.output_dir,
-                                                 f"checkpoint-{global_step}")
+                    # every process saves its random state, the main process the rest
+                    save_path = os.path.join(args.output_dir,
+                                             f"checkpoint-{global_step}")
+                    if accelerator.num_processes > 1:
+                        for discriminator in discriminators:
+                            average_buffers(discriminator,
+                                            accelerator.num_processes)
+                    if args.lightweight_checkpoints:
+                        save_training_state(
+                            save_path, accelerator, text_encoder,
+                            placeholder_token_ids, optimizer, lr_scheduler,
+                            discriminators, optimizers_D, d_grad_scaler,
+                            timestep_sampler, train_sampler)
+                    else:
                         accelerator.save_state(save_path)
-                        logger.info(f"Saved state to {save_path}")
-
-            logs = {
-                "lr": lr_scheduler.get_last_lr()[0],
-                "loss": loss.detach().item(),
-                "denoise_loss": denoise_loss.detach().item(),
-                # "weighted_denoise_loss": weighted_denoise_loss.detach().item(),
-            }
-            # if args.steer_loss_weight > 0:
-            #     logs["steer_loss"] = steer_loss.detach().item()
-            #     logs["weighted_steer_loss"] = weighted_steer_loss.detach(
-            #     ).item()
-
-            progress_bar.set_postfix(**logs)
-            accelerator.log(logs, step=global_step)
+                    logger.info(f"Saved state to {save_path}")
+
+                if (validation_engine is not None
+                        and args.validation_steps is not None
+                        and global_step % args.validation_steps == 0):
+                    run_validation(accelerator, validation_engine, args,
+                                   global_step)
+
+            if validation_engine is not None:
+                finished = validation_engine.poll()
+                if finished is not None:
+                    log_validation(accelerator, finished[1],
+                                   args.validation_prompt, finished[0])
+
+            # the metrics stay on device until they are logged, every `logging_steps` steps
+            metrics.add(loss=loss, denoise_loss=denoise_loss)
+            if args.steer_loss_weight > 0:
+                metrics.add(steer_loss=steer_loss)
+            if args.gan_loss_weight > 0:
+                metrics.add(gan_loss=gan_loss)
+            if accelerator.sync_gradients and (
+                    global_step % args.logging_steps == 0
+                    or global_step >= args.max_train_steps):
+                logs = metrics.flush(reduce=lambda sums: accelerator.reduce(
+                    sums, reduction="mean"))
+                logs["lr"] = lr_scheduler.get_last_lr()[0]
+                logs.update(stage_timer.summary())
+                progress_bar.set_postfix(
+                    **{
+                        name: value
+                        for name, value in logs.items()
+                        if not name.startswith(("time/", "memory/"))
+                    })
+                accelerator.log(logs, step=global_step)
 
             if global_step >= args.max_train_steps:
                 break
+            # logging, checkpointing and validation are not part of the step time
+            if accelerator.sync_gradients:
+                stage_timer.start_step()
+            data_start = time.perf_counter()
 
         # validation
-        if args.validation_prompt is not None and epoch % args.validation_epochs == 0:
-            logger.info(
-                f"Running validation... \n Generating {args.num_validation_images} images with prompt:"
-                f" {args.validation_prompt}.")
-            # create pipeline (note: unet and vae are loaded again in float32)
-            pipeline = DiffusionPipeline.from_pretrained(
-                args.pretrained_model_name_or_path,
-                text_encoder=accelerator.unwrap_model(text_encoder),
-                tokenizer=tokenizer,
-                unet=unet,
-                vae=vae,
-                revision=args.revision,
-                torch_dtype=weight_dtype,
-            )
-            pipeline.scheduler = DPMSolverMultistepScheduler.from_config(
-                pipeline.scheduler.config)
-            pipeline = pipeline.to(accelerator.device)
-            pipeline.set_progress_bar_config(disable=True)
-
-            # run inference
-            generator = (None if args.seed is None else torch.Generator(
-                device=accelerator.device).manual_seed(args.seed))
-            images = []
-            for _ in range(args.num_validation_images):
-                with torch.autocast("cuda"):
-                    image = pipeline(
-                        args.validation_prompt,
-                        num_inference_steps=25,
-                        generator=generator).images[0]
-                images.append(image)
-
-            for tracker in accelerator.trackers:
-                if tracker.name == "tensorboard":
-                    np_images = np.stack([np.asarray(img) for img in images])
-                    tracker.writer.add_images(
-                        "validation", np_images, epoch, dataformats="NHWC")
-                if tracker.name == "wandb":
-                    tracker.log({
-                        "validation": [
-                            wandb.Image(
-                                image,
-                                caption=f"{i}: {args.validation_prompt}")
-                            for i, image in enumerate(images)
-                        ]
-                    })
-
-            del pipeline
-            torch.cuda.empty_cache()
+        if (validation_engine is not None
+                and args.validation_steps is None
+                and epoch % args.validation_epochs == 0):
+            run_validation(accelerator, validation_engine, args, epoch)
+
+    if validation_engine is not None:
+        finished = validation_engine.wait_pending()
+        if finished is not None:
+            log_validation(accelerator, finished[1], args.validation_prompt,
+                           finished[0])
+        validation_engine.close()
+    # training stopped before the end of the profiling window
+    if profiler is not None:
+        stop_profiler(profiler, args)
+
+    # back to the default layout, which saving (and later runs reusing the models) expect
+    if args.channels_last:
+        unet.to(memory_format=torch.contiguous_format)
+        vae.to(memory_format=torch.contiguous_format)
 
     # Create the pipeline using using the trained modules and save it.
     accelerator.wait_for_everyone()
     if accelerator.is_main_process:
         if args.push_to_hub and args.only_save_embeds:
-            logger.warn(
+            logger.warning(
                 "Enabling full model saving because --push_to_hub=True was specified."
             )
             save_full_model = True
         else:
             save_full_model = not args.only_save_embeds
         if save_full_model:
+            if args.compact_embeddings:
+                # merge the trainable rows back into a plain embedding before saving
+                accelerator.unwrap_model(text_encoder).set_input_embeddings(
+                    accelerator.unwrap_model(
+                        text_encoder).get_input_embeddings().to_embedding())
+            from diffusers import StableDiffusionPipeline
             pipeline = StableDiffusionPipeline.from_pretrained(
                 args.pretrained_model_name_or_path,
                 text_encoder=accelerator.unwrap_model(text_encoder),
@@ -1136,9 +3327,13 @@ def main():
             )
             pipeline.save_pretrained(args.output_dir)
         # Save the newly trained embeddings
-        save_path = os.path.join(args.output_dir, "learned_embeds.bin")
-        save_progress(text_encoder, placeholder_token_id, accelerator, args,
-                      save_path)
+        for placeholder_token_id, placeholder_token, relation_output_dir in zip(
+                placeholder_token_ids, args.placeholder_token,
+                relation_output_dirs):
+            save_path = os.path.join(relation_output_dir,
+                                     "learned_embeds.bin")
+            save_progress(text_encoder, placeholder_token_id,
+                          placeholder_token, accelerator, save_path)
 
         if args.push_to_hub:
             repo.push_to_hub(
@@ -1146,7 +3341,31 @@ def main():
                 blocking=False,
                 auto_lfs_prune=True)
 
+    # Hand back the text encoder without the wrappers of `prepare` and with a plain embedding,
+    # so that the models can be reused by another run
+    text_encoder = accelerator.unwrap_model(
+        text_encoder, keep_fp32_wrapper=False)
+    token_embedding = text_encoder.get_input_embeddings()
+    if isinstance(token_embedding, TrainableTokenEmbedding):
+        text_encoder.set_input_embeddings(token_embedding.to_embedding())
+
     accelerator.end_training()
+    accelerator.free_memory()
+
+
+def main():
+    args = parse_args()
+
+    from diffusers.utils import check_min_version
+
+    # Will error if the minimal version of diffusers is not installed. Remove at your own risks.
+    check_min_version("0.13.0.dev0")
+
+    models = load_models(args)
+    tokenizer, _, text_encoder, _, _ = models
+    placeholder_token_ids, initializer_token_ids = add_placeholder_tokens(
+        tokenizer, text_encoder, args)
+    train(args, models, placeholder_token_ids, initializer_token_ids)
 
 
 if __name__ == "__main__":